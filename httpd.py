@@ -1,15 +1,40 @@
 # -*- coding: utf-8 -*-
 import mimetypes
+import mmap
 import socket
+import ssl
 import threading
 import sys
 import signal
 import logging
 import time
 import os
+import posixpath
 import uuid
-from urllib.parse import unquote
+import errno
+import selectors
+import select
+import subprocess
+import tempfile
+import gzip
+import bisect
+import json
+import queue
+import random
+import cProfile
+from concurrent.futures import ThreadPoolExecutor
+import html
+import fnmatch
+from urllib.parse import unquote, quote, parse_qs
 import argparse
+from email.utils import formatdate, parsedate_to_datetime
+from stat import S_ISREG
+from collections import OrderedDict, deque
+
+try:
+    import brotli
+except ImportError:  # optional, only gzip is offered without it
+    brotli = None
 
 logging.basicConfig(format='[%(asctime)s] %(levelname).1s %(message)s',
                     datefmt='%Y.%m.%d %H:%M:%S',
@@ -20,12 +45,69 @@ PORT = 8080
 DOCUMENT_ROOT = 'www'
 
 OK = 200
+CREATED = 201
+NO_CONTENT = 204
+PARTIAL_CONTENT = 206
+NOT_MODIFIED = 304
 NOT_FOUND = 404
 FORBIDDEN = 403
 BAD_REQUEST = 400
 NOT_ALLOWED = 405
+LENGTH_REQUIRED = 411
+PAYLOAD_TOO_LARGE = 413
+RANGE_NOT_SATISFIABLE = 416
+EXPECTATION_FAILED = 417
+REQUEST_HEADER_FIELDS_TOO_LARGE = 431
 INTERNAL_SERVER_ERROR = 500
+NOT_IMPLEMENTED = 501
+SERVICE_UNAVAILABLE = 503
 HTTP_VERSION_NOT_SUPPORTED = 505
+
+SEND_CHUNK_SIZE = 256 * 1024
+UPLOAD_CHUNK_SIZE = 256 * 1024
+CONTINUE_RESPONSE = b'HTTP/1.1 100 Continue\r\n\r\n'
+MAX_RANGES = 16
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+MIN_COMPRESS_SIZE = 256
+# on-the-fly brotli, the default quality 11 takes tens of milliseconds per 100 KB
+BROTLI_QUALITY = 5
+COMPRESSIBLE_TYPES = ('application/javascript', 'application/x-javascript', 'application/json',
+                      'application/xml', 'image/svg+xml')
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+ACCESS_LOG_COMBINED = 'combined'
+ACCESS_LOG_JSON = 'json'
+# quotes, backslashes and control bytes in quoted fields of the combined format are written as \xHH,
+# like nginx does, so a client cannot break a line or forge fields
+ACCESS_LOG_ESCAPES = {c: f'\\x{c:02X}' for c in (*range(0x20), 0x22, 0x5c, 0x7f)}
+
+# set for a server process started by reload: the inherited listening sockets, comma separated HTTP first,
+# and the pipe to report readiness on
+LISTEN_FD_ENV = 'HTTPD_LISTEN_FD'
+READY_FD_ENV = 'HTTPD_READY_FD'
+STOP_POLL_INTERVAL = 0.5
+# threads mode: how long a keep-alive connection stays idle before its worker may leave it to a waiting client
+KEEPALIVE_YIELD_DELAY = 0.05
+RELOAD_READY_TIMEOUT = 30
+RESPAWN_MIN_UPTIME = 5
+RESPAWN_DELAY_MIN = 0.5
+RESPAWN_DELAY_MAX = 30
+VHOSTS_CHECK_INTERVAL = 2
+
+# virtual hosts file keys holding sizes, with the units the matching command line options use
+VHOST_SIZES = {
+    'cache_size': 1024 * 1024,
+    'cache_entry_size': 1024,
+    'compress_cache_size': 1024 * 1024,
+    'path_cache_size': 1024 * 1024,
+    'mmap_cache_size': 1024 * 1024,
+    'mmap_max_size': 1024 * 1024,
+    'autoindex_cache_size': 1024 * 1024,
+}
+VHOST_KEYS = {'root', 'aliases', 'index', 'autoindex', 'max_age', 'mime_types'} | set(VHOST_SIZES)
+
+MODE_THREADS = 'threads'
+MODE_EVENTS = 'events'
 HTML_ERROR = """<html>
 <head>
 <meta charset="UTF-8"> 
@@ -39,6 +121,342 @@ HTML_ERROR = """<html>
 </html>
 """
 
+HTML_LISTING_HEAD = """<html>
+<head>
+<meta charset="UTF-8">
+<title>Index of {path}</title>
+</head>
+<body>
+<h1>Index of {path}</h1>
+<table>
+<tr><th><a href="?sort=name">Name</a></th><th><a href="?sort=size">Size</a></th><th><a href="?sort=mtime">Modified</a></th></tr>
+<tr><td><a href="{parent}">../</a></td><td></td><td></td></tr>
+"""
+LISTING_SORT_KEYS = {
+    'name': None,
+    'size': lambda item: item[2],
+    'mtime': lambda item: item[3],
+}
+
+
+# metric keys: (name, labels)
+CONNECTIONS_TOTAL = ('httpd_connections_total', ())
+CONNECTIONS_CLOSED = ('httpd_connections_closed_total', ())
+REJECTED_LIMIT = ('httpd_connections_rejected_total', (('reason', 'limit'),))
+REJECTED_PER_IP = ('httpd_connections_rejected_total', (('reason', 'per_ip'),))
+RESPONSE_BYTES = ('httpd_response_bytes_total', ())
+REQUEST_SECONDS = ('httpd_request_seconds', ())
+PHASE_ACCEPT_WAIT = ('httpd_phase_seconds', (('phase', 'accept_wait'),))
+PHASE_PARSE = ('httpd_phase_seconds', (('phase', 'parse'),))
+PHASE_RESOLVE = ('httpd_phase_seconds', (('phase', 'resolve'),))
+PHASE_READ = ('httpd_phase_seconds', (('phase', 'read'),))
+PHASE_SEND = ('httpd_phase_seconds', (('phase', 'send'),))
+IO_QUEUED = ('httpd_io_seconds', (('stage', 'queued'),))
+IO_RUN = ('httpd_io_seconds', (('stage', 'run'),))
+IO_QUEUE_FULL = ('httpd_io_queue_full_total', ())
+TLS_HANDSHAKE_FULL = ('httpd_tls_handshakes_total', (('resumed', 'false'),))
+TLS_HANDSHAKE_RESUMED = ('httpd_tls_handshakes_total', (('resumed', 'true'),))
+TLS_HANDSHAKE_FAILED = ('httpd_tls_handshake_errors_total', ())
+SLOW_REQUESTS = ('httpd_slow_requests_total', ())
+
+
+class MetricsShard:
+    """ Counters and histograms updated by a single thread """
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, key, value=1):
+        counters = self.counters
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, key, seconds):
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            # bucket counts, +Inf count, sum
+            histogram = self.histograms[key] = [0] * (len(Metrics.BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(Metrics.BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+
+class Metrics:
+    """ Lock-free on the hot path: every thread updates only its own shard,
+        shards are summed when the Prometheus text is rendered
+    """
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+        self.help = {}
+
+    def shard(self) -> MetricsShard:
+        """ Shard of the calling thread, fetch it once when updating several metrics """
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = MetricsShard()
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def inc(self, key, value=1):
+        self.shard().inc(key, value)
+
+    def observe(self, key, seconds):
+        self.shard().observe(key, seconds)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+    def total(self, key):
+        with self.lock:
+            shards = list(self.shards)
+        return sum(shard.counters.get(key, 0) for shard in shards)
+
+    def render(self, samples=()) -> str:
+        """ Prometheus text exposition format,
+            samples are (name, type, labels, value) computed by the caller
+        """
+        counters, histograms = {}, {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for key, value in list(shard.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, histogram in list(shard.histograms.items()):
+                total = histograms.setdefault(key, [0] * len(histogram[:-1]) + [0.0])
+                for i, value in enumerate(histogram):
+                    total[i] += value
+        lines, typed = [], set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), histogram[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{self._labels(labels)} {histogram[-1]:.6f}')
+            lines.append(f'{name}_count{self._labels(labels)} {cumulative}')
+        for name, kind, labels, value in samples:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class AccessLog:
+    """ Access log written by a background thread: request handlers only enqueue raw records,
+        formatting and file I/O happen in batches off the hot path.
+        When the bounded queue is full records are dropped and counted instead of blocking.
+    """
+    BATCH_SIZE = 512
+
+    def __init__(self, path, fmt=ACCESS_LOG_COMBINED, max_queue=10000):
+        self.path = path
+        self.fmt = fmt
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        """ Starts the writer, again in every forked worker process """
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._write_forever, name='access-log', daemon=True)
+        self.thread.start()
+
+    def log(self, address, data, headers, status, sent, duration):
+        try:
+            self.queue.put_nowait((time.time(), address, data, headers, status, sent, duration))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """ Writes out queued records and stops the writer """
+        if self.thread is None or self.pid != os.getpid():
+            return
+        self.queue.put(None)
+        self.thread.join(5)
+        self.thread = None
+
+    def _write_forever(self):
+        out = sys.stdout if self.path == '-' else open(self.path, 'a', encoding='utf-8')
+        try:
+            while True:
+                batch = [self.queue.get()]
+                while len(batch) < self.BATCH_SIZE:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in batch
+                out.write(''.join(self._format(record) for record in batch if record is not None))
+                out.flush()
+                if stop:
+                    return
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    def _format(self, record) -> str:
+        timestamp, address, data, headers, status, sent, duration = record
+        request_line = data.split(b'\r\n', 1)[0].decode('iso-8859-1')
+        host = address[0] if address else '-'
+        if self.fmt == ACCESS_LOG_JSON:
+            return json.dumps({
+                'time': timestamp,
+                'remote_addr': host,
+                'method': headers.get('command', ''),
+                'path': headers.get('path', ''),
+                'version': headers.get('version', ''),
+                'request': request_line,
+                'status': status,
+                'bytes': sent,
+                'duration': round(duration, 6),
+                'referer': headers.get('referer', ''),
+                'user_agent': headers.get('user-agent', ''),
+            }) + '\n'
+        when = time.strftime('%d/%b/%Y:%H:%M:%S %z', time.localtime(timestamp))
+        request_line = request_line.translate(ACCESS_LOG_ESCAPES)
+        referer = headers.get('referer', '-').translate(ACCESS_LOG_ESCAPES)
+        user_agent = headers.get('user-agent', '-').translate(ACCESS_LOG_ESCAPES)
+        return f'{host} - - [{when}] "{request_line}" {status} {sent} ' \
+               f'"{referer}" "{user_agent}" {duration:.6f}\n'
+
+
+class RequestTrace:
+    """ Timestamps of one request: every mark attributes the time since the previous one to a phase """
+    __slots__ = ('started', 'last', 'phases', 'request', 'sampled', 'profile')
+
+    def __init__(self, sampled=False):
+        self.started = self.last = time.perf_counter_ns()
+        self.phases = []
+        self.request = b''
+        self.sampled = sampled
+        self.profile = None
+
+    def mark(self, phase):
+        now = time.perf_counter_ns()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    @property
+    def total_ns(self) -> int:
+        return self.last - self.started
+
+
+class Tracer:
+    """ Opt-in per-request phase tracing: requests slower than the threshold are logged with their breakdown,
+        a sampled fraction of requests is run under cProfile. Dumps are written by a background thread
+        into a directory that keeps only the newest files, so tracing never blocks on the disk.
+    """
+    EXTENSIONS = ('.json', '.prof')
+
+    def __init__(self, threshold=None, directory=None, keep=100, profile_rate=0.0, max_queue=1000):
+        self.threshold_ns = int(threshold * 1e9) if threshold is not None else None
+        self.directory = directory
+        self.keep = keep
+        self.profile_rate = profile_rate
+        self.queue = queue.Queue(max_queue)
+        # one profiled request at a time: cProfile is heavy, and Python 3.12+ allows a single active profiler
+        self.profiling = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        """ Starts the dump writer, again in every forked worker process """
+        if self.directory is None or (self.thread is not None and self.pid == os.getpid()):
+            return
+        self.pid = os.getpid()
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._write_forever, name='tracer', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread is None or self.pid != os.getpid():
+            return
+        self.queue.put(None)
+        self.thread.join(5)
+        self.thread = None
+
+    def begin(self) -> RequestTrace:
+        return RequestTrace(sampled=self.profile_rate > 0 and random.random() < self.profile_rate)
+
+    def profile(self, trace, func, *args):
+        """ Calls func under cProfile unless another request is being profiled """
+        if not self.profiling.acquire(blocking=False):
+            return func(*args)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args)
+        finally:
+            self.profiling.release()
+            trace.profile = profiler
+
+    def finish(self, trace, address) -> bool:
+        """ Reports a request whose response has been sent, returns whether it was slow """
+        slow = self.threshold_ns is not None and trace.total_ns >= self.threshold_ns
+        if slow:
+            request_line = trace.request.split(b'\r\n', 1)[0].decode('iso-8859-1')
+            breakdown = ', '.join(f'{phase} {ns / 1e6:.3f}' for phase, ns in trace.phases)
+            logging.warning(f'SLOW REQUEST "{request_line}" from {address[0] if address else "-"}: '
+                            f'{trace.total_ns / 1e6:.3f} ms ({breakdown})')
+        if self.thread is not None and (slow or trace.profile is not None):
+            try:
+                self.queue.put_nowait((time.time(), trace, address, slow))
+            except queue.Full:
+                pass
+        return slow
+
+    def _write_forever(self):
+        written = deque(sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                               if name.endswith(self.EXTENSIONS)))
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            timestamp, trace, address, slow = record
+            # time first: names sort in the order they were written
+            base = os.path.join(self.directory, f'{time.time_ns()}-{os.getpid()}')
+            try:
+                if slow:
+                    with open(base + '.json', 'w', encoding='utf-8') as f:
+                        json.dump({
+                            'time': timestamp,
+                            'remote_addr': address[0] if address else '-',
+                            'request': trace.request.split(b'\r\n', 1)[0].decode('iso-8859-1'),
+                            'total_ms': trace.total_ns / 1e6,
+                            'phases_ms': [[phase, ns / 1e6] for phase, ns in trace.phases],
+                        }, f)
+                    written.append(base + '.json')
+                if trace.profile is not None:
+                    trace.profile.dump_stats(base + '.prof')
+                    written.append(base + '.prof')
+            except OSError as e:
+                logging.error(f'Could not write the trace of a request to {self.directory}: {e}')
+            while len(written) > self.keep:
+                try:
+                    os.unlink(written.popleft())
+                except OSError:
+                    pass
+
 
 class Server:
     """
@@ -46,67 +464,972 @@ class Server:
     request: "My name is Svyatoslav"
     response: "Hello, Svyatoslav"
     """
-    def __init__(self, host, port, workers):
+    def __init__(self, host, port, workers, mode=MODE_THREADS, processes=1,
+                 keepalive_timeout=5, max_requests=100, drain_timeout=10,
+                 backlog=1024, max_connections=0, max_connections_per_ip=0, retry_after=1,
+                 io_threads=0, io_queue=256, tls_port=None, certfile=None, keyfile=None, tls_tickets=2,
+                 trace_slow=None, trace_dir=None, trace_keep=100, profile_rate=0.0):
         self.host = host
         self.port = port
+        self.tls_port = tls_port
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.tls_tickets = tls_tickets
+        self.tls_context = None
+        self.sock = None
+        self.tls_sock = None
+        self.listeners = []
         self.read_size = 1024
+        self.timeout = 10
+        self.keepalive_timeout = keepalive_timeout
+        self.max_requests = max_requests
         self.workers = workers
+        self.mode = mode
+        self.processes = processes
         self.opened_threads = []
+        self.children = {}
+        self.stopping = False
+        self.drain_timeout = drain_timeout
+        self.drain_deadline = None
+        self.reload_requested = False
+        self.ready_fd = None
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.retry_after = retry_after
+        self.admission_lock = threading.Lock()
+        self.open_connections = 0
+        self.connections_per_ip = {}
+        self.io_threads = io_threads
+        self.io_queue = io_queue
+        self.io_pool = None
+        self.io_lock = threading.Lock()
+        # threads mode: workers waiting in accept, an idle keep-alive connection yields its thread when none is left
+        self.accepting = 0
+        self.accepting_lock = threading.Lock()
+        # set in a worker thread that already counted itself in accepting when it gave up an idle connection
+        self._accept_claim = threading.local()
+        self.io_pending = 0
+        self._event_loop = threading.local()
+        self.metrics = Metrics()
+        self.tracer = None
+        if trace_slow is not None or profile_rate:
+            self.tracer = Tracer(trace_slow, trace_dir, trace_keep, profile_rate)
 
     def start(self):
-        """ Attempts to aquire the socket and launch the server """
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        logging.info(f"Launching HTTP server on {self.host} : {self.port}")
+        """ Attempts to aquire the sockets, or takes over the ones inherited on reload,
+            and serves until shutdown
+        """
+        inherited = os.environ.pop(LISTEN_FD_ENV, None)
+        inherited = [int(fd) for fd in inherited.split(',')] if inherited else []
+        ready_fd = os.environ.pop(READY_FD_ENV, None)
+        self.ready_fd = int(ready_fd) if ready_fd is not None else None
+        if self.tls_port:
+            # created before forking: worker processes share the session ticket keys and resume each other's sessions
+            self.tls_context = self._create_tls_context()
+        self.sock = self._open_listener(self.port, inherited[0] if inherited else None, 'HTTP')
+        self.listeners = [(self.sock, None)]
+        if self.tls_context is not None:
+            self.tls_sock = self._open_listener(self.tls_port, inherited[1] if len(inherited) > 1 else None, 'HTTPS')
+            self.listeners.append((self.tls_sock, self.tls_context))
+        logging.info("Press Ctrl+C to shut down the server and exit.")
+        if self.processes > 1:
+            self._supervise()
+        else:
+            self._start_workers()
+            self._notify_ready()
+            self._wait_workers()
+            self._after_workers_stop()
+        for sock, _ in self.listeners:
+            sock.close()
+        logging.info("Server stopped")
+
+    def _open_listener(self, port, inherited_fd, scheme) -> socket.socket:
+        """ Takes over the listening socket inherited on reload or binds a new one """
+        if inherited_fd is not None:
+            logging.info(f"Took over the {scheme} listening socket on {self.host} : {port}")
+            return socket.socket(fileno=inherited_fd)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        logging.info(f"Launching {scheme} server on {self.host} : {port}")
         try:
-            self.sock.bind((self.host, self.port))
+            sock.bind((self.host, port))
         except Exception:
-            logging.info(f"ERROR: Failed to acquire sockets for port {self.port}")
+            logging.info(f"ERROR: Failed to acquire sockets for port {port}")
             logging.info("Try running the Server in a privileged user mode.")
-            self.shutdown()
+            sock.close()
             sys.exit(1)
+        logging.info(f"Server successfully acquired the socket with port: {port}")
+        sock.listen(self.backlog)
+        return sock
 
-        logging.info(f"Server successfully acquired the socket with port: {self.port}")
-        logging.info("Press Ctrl+C to shut down the server and exit.")
+    def _create_tls_context(self) -> ssl.SSLContext:
+        """ Server context resuming sessions from its cache (TLS 1.2) and with session tickets """
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        try:
+            context.load_cert_chain(self.certfile, self.keyfile)
+        except (OSError, ssl.SSLError) as e:
+            logging.info(f"ERROR: Failed to load the TLS certificate {self.certfile}: {e}")
+            sys.exit(1)
+        context.set_alpn_protocols(['http/1.1'])
+        if self.tls_tickets:
+            context.num_tickets = self.tls_tickets
+        else:
+            context.options |= ssl.OP_NO_TICKET
+            context.num_tickets = 0
+        return context
+
+    def _start_workers(self):
+        self._before_workers_start()
         logging.debug('STARTING WORKERS')
+        target = self._serve_events if self.mode == MODE_EVENTS else self._listen
         for _ in range(self.workers):
             worker_key = f'WORKER {uuid.uuid1()}'
-            logging.info(f'Starting worker with key: {worker_key}')
-            t = threading.Thread(target=self._listen, args=(worker_key,))
+            logging.info(f'Starting {self.mode} worker with key: {worker_key}')
+            # daemon: the main thread decides when the process ends, cutting off what outlived the drain deadline
+            t = threading.Thread(target=target, args=(worker_key,), daemon=True)
             t.start()
             self.opened_threads.append(t)
         logging.debug('WORKERS STARTED')
 
-    def _listen(self, worker_key):
-        self.sock.listen(5)
-        threading.currentThread()
+    def _wait_workers(self):
+        """ Main thread: serves reload requests until the worker threads have drained or the deadline passed """
+        while any(t.is_alive() for t in self.opened_threads):
+            if self.reload_requested:
+                self._reload()
+            if self.stopping and time.monotonic() > self.drain_deadline:
+                alive = sum(t.is_alive() for t in self.opened_threads)
+                logging.info(f"Drain timeout, cutting off {alive} busy workers")
+                return
+            time.sleep(STOP_POLL_INTERVAL)
+
+    def _supervise(self):
+        """ Forks worker processes sharing the pre-bound listening socket and restarts dead ones """
+        for _ in range(self.processes):
+            self._spawn_child()
+        self._notify_ready()
+        respawns = 0
+        respawn_at = respawn_delay = 0
         while True:
-            logging.debug(f'{worker_key}: ACCEPTING')
+            if respawns and not self.stopping and time.monotonic() >= respawn_at:
+                respawns -= 1
+                self._spawn_child()
+            if self.reload_requested:
+                self._reload()
+            if self.stopping and time.monotonic() > self.drain_deadline + 1:
+                for pid in self.children:
+                    logging.info(f"Worker process {pid} did not drain in time, killing")
+                    os.kill(pid, signal.SIGKILL)
+            if self.stopping and not self.children:
+                return
+            # only our workers: the server started by a reload is a child too and outlives this supervisor
+            pid, status, uptime = self._reap_child()
+            if not pid:
+                time.sleep(STOP_POLL_INTERVAL)
+                continue
+            if self.stopping:
+                continue
+            # a worker that dies right after start will most likely die again, back off instead of a fork loop
+            if uptime < RESPAWN_MIN_UPTIME:
+                respawn_delay = min(max(respawn_delay * 2, RESPAWN_DELAY_MIN), RESPAWN_DELAY_MAX)
+            else:
+                respawn_delay = 0
+            respawn_at = time.monotonic() + respawn_delay
+            respawns += 1
+            logging.info(f'Worker process {pid} died with status {status} after {uptime:.1f} s, '
+                         f'restarting in {respawn_delay} s')
+
+    def _reap_child(self) -> tuple:
+        """ Collects one exited worker process without blocking
+            returns tuple: pid, status, seconds the worker lived, pid is 0 if all workers are alive
+        """
+        for pid in list(self.children):
             try:
-                client, address = self.sock.accept()
-            except OSError:
+                reaped, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                reaped, status = pid, 0
+            if reaped:
+                return pid, status, time.monotonic() - self.children.pop(pid)
+        return 0, 0, 0
+
+    def _spawn_child(self):
+        pid = os.fork()
+        if pid:
+            logging.info(f'Started worker process {pid}')
+            self.children[pid] = time.monotonic()
+            return pid
+        # child: the supervisor handles Ctrl+C and reloads, and stops us with SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self.shutdown)
+        self.children = {}
+        if self.ready_fd is not None:
+            os.close(self.ready_fd)
+            self.ready_fd = None
+        self._start_workers()
+        self._wait_workers()
+        self._after_workers_stop()
+        logging.shutdown()
+        os._exit(0)
+
+    def _notify_ready(self):
+        """ Tells the process that started us on reload that we serve requests now """
+        if self.ready_fd is None:
+            return
+        os.write(self.ready_fd, b'1')
+        os.close(self.ready_fd)
+        self.ready_fd = None
+
+    def _reload(self):
+        """ Starts a new server process on the same listening socket and drains this one once it is ready,
+            the socket stays open throughout so no connection is refused
+        """
+        self.reload_requested = False
+        if self.stopping:
+            return
+        logging.info("Reloading: starting a new server process")
+        ready_r, ready_w = os.pipe()
+        fds = [sock.fileno() for sock, _ in self.listeners]
+        env = dict(os.environ, **{LISTEN_FD_ENV: ','.join(map(str, fds)), READY_FD_ENV: str(ready_w)})
+        try:
+            process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=(*fds, ready_w))
+        except OSError as e:
+            logging.error(f"Reload failed, could not start a new server process: {e}")
+            os.close(ready_r)
+            os.close(ready_w)
+            return
+        os.close(ready_w)
+        readable, _, _ = select.select([ready_r], [], [], RELOAD_READY_TIMEOUT)
+        ready = bool(readable) and os.read(ready_r, 1) == b'1'
+        os.close(ready_r)
+        if not ready:
+            logging.error(f"Reload failed, new server process {process.pid} did not become ready, keep serving")
+            process.kill()
+            process.wait()
+            return
+        logging.info(f"New server process {process.pid} is ready, draining this one")
+        self.shutdown()
+
+    def reload(self, signum=None, frame=None):
+        """ Requests a zero-downtime reload, usable as a signal handler """
+        self.reload_requested = True
+
+    def _listen(self, worker_key):
+        contexts = dict(self.listeners)
+        for sock in contexts:
+            sock.setblocking(False)
+        self._count_accepting(1)
+        while not self.stopping:
+            logging.debug('%s: ACCEPTING', worker_key)
+            started = time.perf_counter()
+            # waiting gives up periodically so that the worker notices a shutdown
+            try:
+                readable, _, _ = select.select(list(contexts), [], [], STOP_POLL_INTERVAL)
+            except (OSError, ValueError):
                 return False
-            logging.debug(f'{worker_key}: ADDRESS: {address}')
-            logging.debug(f'{worker_key}: SET TIMEOUT')
-            client.settimeout(10)
-            self._listen_to_client(client, address, worker_key, ' ')
+            for sock in readable:
+                try:
+                    client, address = sock.accept()
+                except BlockingIOError:
+                    continue  # another worker took it
+                except OSError:
+                    return False
+                self.metrics.observe(PHASE_ACCEPT_WAIT, time.perf_counter() - started)
+                if not self._admit(address):
+                    self._reject(client, contexts[sock] is not None)
+                    continue
+                self.metrics.inc(CONNECTIONS_TOTAL)
+                logging.debug('%s: ADDRESS: %s', worker_key, address)
+                logging.debug('%s: SET TIMEOUT', worker_key)
+                trace = self.tracer.begin() if self.tracer is not None else None
+                client.settimeout(self.timeout)
+                if contexts[sock] is not None:
+                    client = self._tls_handshake(contexts[sock], client, address)
+                    if client is None:
+                        continue
+                    if trace is not None:
+                        trace.mark('handshake')
+                self._count_accepting(-1)
+                self._accept_claim.claimed = False
+                try:
+                    self._listen_to_client(client, address, worker_key, ' ', trace)
+                finally:
+                    if not self._accept_claim.claimed:
+                        self._count_accepting(1)
+
+    def _count_accepting(self, delta):
+        with self.accepting_lock:
+            self.accepting += delta
 
-    def _listen_to_client(self, client, address, worker_key,  thread_key):
-        logging.debug(f'{worker_key} : THREAD {thread_key} : STARTED NEW THREAD FOR {address}')
+    def _claim_accept(self) -> bool:
+        """ Lets this worker give up its idle connection to accept a waiting client,
+            True for one thread only while no worker waits in accept
+        """
+        with self.accepting_lock:
+            if self.accepting:
+                return False
+            self.accepting += 1
+        self._accept_claim.claimed = True
+        return True
+
+    def _tls_handshake(self, context, client, address):
+        """ Blocking handshake for the threads mode, returns the TLS socket or None if it failed """
         try:
-            logging.debug(f'{worker_key} : THREAD {thread_key} : GETTING DATA')
-            data = client.recv(self.read_size)
-        except OSError:
-            logging.info(f'{worker_key} : THREAD {thread_key} : CLIENT DISCONNECTED, EXITING')
+            client = context.wrap_socket(client, server_side=True)
+        except OSError as e:
+            logging.debug('TLS HANDSHAKE WITH %s FAILED: %s', address, e)
+            self.metrics.inc(TLS_HANDSHAKE_FAILED)
+            self.metrics.inc(CONNECTIONS_CLOSED)
+            self._release(address)
             client.close()
-        logging.debug(f'{worker_key} : THREAD {thread_key} : DATA IS: {data}')
-        if data:
-            response = self.get_response(data)
-            client.sendall(response)
-            logging.info(f'{worker_key} : THREAD {thread_key} : RESPONSE SENDED, EXITING')
+            return None
+        self.metrics.inc(TLS_HANDSHAKE_RESUMED if client.session_reused else TLS_HANDSHAKE_FULL)
+        return client
+
+    def _serve_events(self, worker_key):
+        """ Serves many clients from one thread, multiplexing sockets with a selector.
+            Every worker runs its own loop over the shared non-blocking listening socket.
+        """
+        selector = selectors.DefaultSelector()
+        contexts = dict(self.listeners)
+        for sock in contexts:
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ)
+        connections = {}
+        draining = False
+        next_sweep = 0
+        # requests answered on the I/O pool come back through completed, the waker interrupts select
+        waker_r, waker_w = socket.socketpair()
+        waker_r.setblocking(False)
+        waker_w.setblocking(False)
+        selector.register(waker_r, selectors.EVENT_READ)
+        completed = deque()
+        self._event_loop.completed = completed
+        self._event_loop.waker = waker_w
+        self._event_loop.chunk = memoryview(bytearray(UPLOAD_CHUNK_SIZE))
+        while True:
+            if self.stopping and not draining:
+                logging.debug('%s: DRAINING %s CONNECTIONS', worker_key, len(connections))
+                for sock in contexts:
+                    selector.unregister(sock)
+                draining = True
+            for key, mask in selector.select(timeout=STOP_POLL_INTERVAL):
+                if key.fileobj in contexts:
+                    try:
+                        client, address = key.fileobj.accept()
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        logging.debug('%s: LISTENING SOCKET CLOSED', worker_key)
+                        for conn in list(connections.values()):
+                            self._close_connection(selector, connections, conn)
+                        selector.close()
+                        waker_r.close()
+                        waker_w.close()
+                        return False
+                    logging.debug('%s: ADDRESS: %s', worker_key, address)
+                    context = contexts[key.fileobj]
+                    if not self._admit(address):
+                        self._reject(client, context is not None)
+                        continue
+                    self.metrics.inc(CONNECTIONS_TOTAL)
+                    client.setblocking(False)
+                    if context is not None:
+                        client = context.wrap_socket(client, server_side=True, do_handshake_on_connect=False)
+                    conn = Connection(client, address, self.read_size, tls=context is not None)
+                    if self.tracer is not None:
+                        conn.trace = self.tracer.begin()
+                    connections[client.fileno()] = conn
+                    selector.register(client, selectors.EVENT_READ, conn)
+                elif key.fileobj is waker_r:
+                    try:
+                        while waker_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    self._complete_offloaded(selector, connections, completed)
+                elif key.data.handshaking:
+                    self._continue_handshake(selector, connections, key.data)
+                elif mask & selectors.EVENT_READ:
+                    self._on_readable(selector, connections, key.data)
+                elif mask & selectors.EVENT_WRITE:
+                    self._on_writable(selector, connections, key.data)
+            now = time.monotonic()
+            # the sweeps walk every connection, under load select returns far more often than timeouts need checking
+            if now < next_sweep:
+                continue
+            next_sweep = now + STOP_POLL_INTERVAL
+            for conn in [c for c in connections.values() if c.last_active < now - self._idle_limit(c)]:
+                logging.debug('%s: CLIENT %s TIMED OUT', worker_key, conn.address)
+                self._close_connection(selector, connections, conn)
+            if draining:
+                for conn in [c for c in connections.values() if now > self.drain_deadline or self._is_idle(c)]:
+                    self._close_connection(selector, connections, conn)
+                if not connections:
+                    selector.close()
+                    waker_r.close()
+                    waker_w.close()
+                    return False
+
+    def _admit(self, address) -> bool:
+        """ Counts a new connection in, False if it would exceed the connection limits """
+        if not self.max_connections and not self.max_connections_per_ip:
+            return True
+        ip = address[0]
+        with self.admission_lock:
+            if self.max_connections and self.open_connections >= self.max_connections:
+                rejected = REJECTED_LIMIT
+            elif self.max_connections_per_ip and self.connections_per_ip.get(ip, 0) >= self.max_connections_per_ip:
+                rejected = REJECTED_PER_IP
+            else:
+                self.open_connections += 1
+                self.connections_per_ip[ip] = self.connections_per_ip.get(ip, 0) + 1
+                return True
+        logging.debug('CONNECTION FROM %s REJECTED: %s', address, rejected[1][0][1])
+        self.metrics.inc(rejected)
+        return False
+
+    def _release(self, address):
+        """ Counts a closed connection out of the limits """
+        if not self.max_connections and not self.max_connections_per_ip:
+            return
+        ip = address[0]
+        with self.admission_lock:
+            self.open_connections -= 1
+            left = self.connections_per_ip.pop(ip) - 1
+            if left:
+                self.connections_per_ip[ip] = left
+
+    def _reject(self, client, tls=False):
+        """ Answers a connection over the limits with 503 at once, without reading the request,
+            TLS clients are only closed since answering them would take a handshake
+        """
+        if tls:
             client.close()
-        else:
-            raise socket.error('Client disconnected')
+            return
+        body = b'Server is busy, retry later\n'
+        response = gen_headers(SERVICE_UNAVAILABLE, len(body), 'text/plain', False,
+                               {'Retry-After': self.retry_after}) + body
+        try:
+            client.setblocking(False)
+            client.send(response)
+            client.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        client.close()
+
+    def _idle_limit(self, conn):
+        """ Keep-alive timeout applies between requests, the read timeout inside one """
+        return self.keepalive_timeout if self._is_idle(conn) else self.timeout
+
+    @staticmethod
+    def _is_idle(conn) -> bool:
+        """ Whether a persistent connection waits for its next request """
+        return conn.served and not conn.inbuf and not conn.outparts and conn.pending is None and conn.upload is None
+
+    def _continue_handshake(self, selector, connections, conn):
+        """ Advances a TLS handshake as far as the socket allows without blocking the loop """
+        try:
+            conn.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            selector.modify(conn.sock, selectors.EVENT_READ, conn)
+            return
+        except ssl.SSLWantWriteError:
+            selector.modify(conn.sock, selectors.EVENT_WRITE, conn)
+            return
+        except OSError as e:
+            logging.debug('TLS HANDSHAKE WITH %s FAILED: %s', conn.address, e)
+            self.metrics.inc(TLS_HANDSHAKE_FAILED)
+            self._close_connection(selector, connections, conn)
+            return
+        conn.handshaking = False
+        conn.last_active = time.monotonic()
+        if conn.trace is not None:
+            conn.trace.mark('handshake')
+        self.metrics.inc(TLS_HANDSHAKE_RESUMED if conn.sock.session_reused else TLS_HANDSHAKE_FULL)
+        selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def _on_readable(self, selector, connections, conn):
+        while True:
+            if conn.upload is not None and not conn.inbuf:
+                self._on_upload_readable(selector, connections, conn)
+            else:
+                try:
+                    received = conn.inbuf.fill(conn.sock)
+                except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                    return
+                except OSError:
+                    received = 0
+                if not received:
+                    logging.debug('CLIENT %s DISCONNECTED', conn.address)
+                    self._close_connection(selector, connections, conn)
+                    return
+                conn.last_active = time.monotonic()
+                if self.tracer is not None and conn.trace is None:
+                    conn.trace = self.tracer.begin()
+                self._process_buffered(selector, connections, conn)
+            if not self._tls_pending(conn):
+                return
+
+    @staticmethod
+    def _tls_pending(conn) -> bool:
+        """ Whether a connection waiting for input has decrypted bytes left in its TLS layer,
+            which the selector does not report since they were already read from the socket
+        """
+        return conn.tls and conn.sock.fileno() != -1 and conn.pending is None and not conn.outparts \
+            and not conn.inbuf.full and conn.sock.pending() > 0
+
+    def _on_upload_readable(self, selector, connections, conn):
+        """ Receives request body bytes straight into the loop's chunk buffer and on into the upload """
+        chunk = self._event_loop.chunk
+        try:
+            received = conn.sock.recv_into(chunk)
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except OSError:
+            received = 0
+        if not received:
+            logging.debug('CLIENT %s DISCONNECTED INSIDE THE BODY', conn.address)
+            self._close_connection(selector, connections, conn)
+            return
+        conn.last_active = time.monotonic()
+        if self._offload_feed(selector, connections, conn, chunk[:received]):
+            return
+        consumed = conn.upload.feed(chunk[:received])
+        if consumed < received and not conn.inbuf.append(chunk[consumed:received]):
+            conn.upload.keep_alive = False
+        if conn.upload.complete:
+            self._process_buffered(selector, connections, conn)
+
+    def _offload_feed(self, selector, connections, conn, data) -> bool:
+        """ Writes body bytes into the upload on the I/O pool, the connection is not read meanwhile.
+            False when there is no pool or its queue is full, the caller writes them itself then.
+        """
+        if self.io_pool is None:
+            return False
+        data = bytes(data)
+        upload = conn.upload
+
+        def resume(consumed):
+            conn.last_active = time.monotonic()
+            if consumed < len(data) and not conn.inbuf.append(memoryview(data)[consumed:]):
+                upload.keep_alive = False
+            self._resume(selector, conn)
+            self._process_buffered(selector, connections, conn)
+            if self._tls_pending(conn):
+                self._on_readable(selector, connections, conn)
+
+        if not self._submit(conn, lambda: upload.feed(data), resume=resume):
+            return False
+        if not conn.outparts:
+            selector.unregister(conn.sock)
+        return True
+
+    @staticmethod
+    def _resume(selector, conn):
+        """ Watches a connection again once the I/O pool is done with it """
+        events = selectors.EVENT_WRITE if conn.outparts else selectors.EVENT_READ
+        try:
+            selector.modify(conn.sock, events, conn)
+        except KeyError:
+            selector.register(conn.sock, events, conn)
+
+    def _process_buffered(self, selector, connections, conn):
+        """ Answers every complete request in the input buffer, pipelined ones in one write """
+        answered = False
+        while conn.keep_alive and conn.pending is None:
+            if conn.upload is not None:
+                if conn.inbuf and not conn.upload.complete:
+                    if self._offload_feed(selector, connections, conn, conn.inbuf.view[:len(conn.inbuf)]):
+                        conn.inbuf.consume(len(conn.inbuf))
+                        break
+                    conn.inbuf.consume(conn.upload.feed(conn.inbuf.view[:len(conn.inbuf)]))
+                if not conn.upload.complete:
+                    break
+                upload, conn.upload = conn.upload, None
+                trace, conn.trace = conn.trace, None
+                if trace is not None:
+                    trace.mark('body')
+                if self.io_pool is not None and self._submit(conn, lambda: self.finish_upload(upload), trace):
+                    if not conn.outparts:
+                        selector.unregister(conn.sock)
+                    break
+                parts, conn.keep_alive = self.finish_upload(upload)
+                self._queue_response(conn, parts, trace)
+                answered = True
+                continue
+            size = self._request_size(conn.inbuf)
+            if not size:
+                break
+            request = conn.inbuf.consume(size)
+            trace, conn.trace = conn.trace, None
+            if self.tracer is not None:
+                trace = trace or self.tracer.begin()
+                trace.request = request
+                trace.mark('recv')
+            can_keep_alive = conn.served + 1 < self.max_requests and not self.stopping
+            if self.io_pool is not None and self._needs_io(request) and \
+                    self._offload(conn, request, can_keep_alive, trace):
+                if not conn.outparts:
+                    # nothing to send or read until the pool answers, later requests wait in the buffer
+                    selector.unregister(conn.sock)
+                break
+            parts, keep_alive = self.handle_request(request, can_keep_alive, conn.address, trace)
+            if isinstance(parts, Upload):
+                answered = self._begin_upload(conn, parts, trace) or answered
+                continue
+            conn.keep_alive = keep_alive
+            self._queue_response(conn, parts, trace)
+            answered = True
+        if not answered:
+            return
+        selector.modify(conn.sock, selectors.EVENT_WRITE, conn)
+        self._on_writable(selector, connections, conn)
+
+    @staticmethod
+    def _begin_upload(conn, upload, trace) -> bool:
+        """ Attaches an upload to the connection, True if an interim response was queued """
+        # the trace goes on through the body
+        conn.trace = trace
+        conn.upload = upload
+        if not upload.interim:
+            return False
+        if not conn.outparts:
+            conn.send_started = time.perf_counter()
+        conn.outparts.append(memoryview(upload.interim))
+        return True
+
+    def _queue_response(self, conn, parts, trace=None):
+        conn.served += 1
+        if not conn.outparts:
+            conn.send_started = time.perf_counter()
+        if trace is not None:
+            conn.traces.append(trace)
+        for part in parts:
+            if isinstance(part, FileRegion):
+                # sendfile would bypass the encryption
+                part.use_sendfile = part.use_sendfile and not conn.tls
+                conn.outparts.append(part)
+            else:
+                conn.outparts.append(memoryview(part))
+
+    def _needs_io(self, request) -> bool:
+        """ Whether answering the request would block on the disk, such requests go to the I/O pool """
+        return False
+
+    def _offload(self, conn, request, can_keep_alive, trace=None) -> bool:
+        """ Answers the request on the I/O pool, False when the pool queue is full """
+        return self._submit(conn, lambda: self.handle_request(request, can_keep_alive, conn.address, trace), trace)
+
+    def _submit(self, conn, work, trace=None, resume=None) -> bool:
+        """ Runs work on the I/O pool for the connection, False when the pool queue is full.
+            Its result goes to resume on the loop thread, without one it is a response tuple like handle_request.
+        """
+        with self.io_lock:
+            if self.io_pending >= self.io_queue:
+                self.metrics.inc(IO_QUEUE_FULL)
+                return False
+            self.io_pending += 1
+        completed, waker = self._event_loop.completed, self._event_loop.waker
+        submitted = time.perf_counter()
+
+        def run():
+            started = time.perf_counter()
+            if trace is not None:
+                trace.mark('io_queue')
+            try:
+                return work()
+            finally:
+                shard = self.metrics.shard()
+                shard.observe(IO_QUEUED, started - submitted)
+                shard.observe(IO_RUN, time.perf_counter() - started)
+                with self.io_lock:
+                    self.io_pending -= 1
+
+        def done(_):
+            completed.append((conn, trace, resume))
+            try:
+                waker.send(b'\0')
+            except OSError:
+                pass  # already woken, or the loop is gone
+
+        conn.pending = self.io_pool.submit(run)
+        conn.pending.add_done_callback(done)
+        return True
+
+    def _complete_offloaded(self, selector, connections, completed):
+        """ Queues the responses the I/O pool produced and resumes their connections """
+        while completed:
+            conn, trace, resume = completed.popleft()
+            future, conn.pending = conn.pending, None
+            try:
+                result = future.result()
+            except Exception:
+                logging.exception('REQUEST FROM %s FAILED', conn.address)
+                self._close_connection(selector, connections, conn)
+                continue
+            if conn.sock.fileno() == -1:
+                # timed out or cut off by the drain deadline meanwhile
+                if resume is None:
+                    parts = result[0]
+                    if isinstance(parts, Upload):
+                        parts.abort()
+                        continue
+                    for part in parts:
+                        if isinstance(part, FileRegion):
+                            part.close()
+                continue
+            if resume is not None:
+                resume(result)
+                continue
+            parts, keep_alive = result
+            if isinstance(parts, Upload):
+                self._begin_upload(conn, parts, trace)
+                self._resume(selector, conn)
+                if conn.outparts:
+                    self._on_writable(selector, connections, conn)
+                else:
+                    self._process_buffered(selector, connections, conn)
+                continue
+            conn.keep_alive = keep_alive
+            self._queue_response(conn, parts, trace)
+            self._resume(selector, conn)
+            self._on_writable(selector, connections, conn)
+
+    def _on_writable(self, selector, connections, conn):
+        parts = conn.outparts
+        while parts:
+            part = parts[0]
+            try:
+                if isinstance(part, FileRegion):
+                    sent = part.send_nonblocking(conn.sock)
+                    if not sent and part.count:
+                        logging.debug('FILE %s SHRANK WHILE SENDING', part.path)
+                        self._close_connection(selector, connections, conn)
+                        return
+                elif conn.tls:
+                    sent = conn.sock.send(part)
+                else:
+                    sent = conn.sock.send(part, MSG_MORE if len(parts) > 1 else 0)
+            except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                # a TLS write is retried with the same part, as OpenSSL requires
+                return
+            except OSError:
+                self._close_connection(selector, connections, conn)
+                return
+            conn.last_active = time.monotonic()
+            if isinstance(part, FileRegion):
+                if not part.count:
+                    part.close()
+                    parts.popleft()
+            elif sent == len(part):
+                parts.popleft()
+            else:
+                parts[0] = part[sent:]
+                return
+        self.metrics.observe(PHASE_SEND, time.perf_counter() - conn.send_started)
+        # pipelined responses are sent together, each is timed up to the end of the batch
+        while conn.traces:
+            trace = conn.traces.popleft()
+            trace.mark('send')
+            self._finish_trace(trace, conn.address)
+        if conn.pending is not None:
+            selector.unregister(conn.sock)
+            return
+        if not conn.keep_alive:
+            logging.debug('RESPONSE SENDED TO %s, CLOSING', conn.address)
+            self._close_connection(selector, connections, conn)
+            return
+        logging.debug('RESPONSE SENDED TO %s, KEEPING ALIVE', conn.address)
+        selector.modify(conn.sock, selectors.EVENT_READ, conn)
+        self._process_buffered(selector, connections, conn)
+        if self._tls_pending(conn):
+            self._on_readable(selector, connections, conn)
+
+    def _finish_trace(self, trace, address):
+        if self.tracer.finish(trace, address):
+            self.metrics.inc(SLOW_REQUESTS)
+
+    def _close_connection(self, selector, connections, conn):
+        self.metrics.inc(CONNECTIONS_CLOSED)
+        self._release(conn.address)
+        if conn.upload is not None:
+            if conn.pending is not None:
+                # the pool may be writing into it right now
+                conn.pending.add_done_callback(lambda _, upload=conn.upload: upload.abort())
+            else:
+                conn.upload.abort()
+            conn.upload = None
+        connections.pop(conn.sock.fileno(), None)
+        try:
+            selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        for part in conn.outparts:
+            if isinstance(part, FileRegion):
+                part.close()
+        conn.outparts.clear()
+        conn.sock.close()
+
+    def _request_size(self, buffer) -> int:
+        """ Length of the first complete request in the RequestBuffer, 0 if more data is needed """
+        return len(buffer)
+
+    def _listen_to_client(self, client, address, worker_key,  thread_key, trace=None):
+        logging.debug('%s : THREAD %s : STARTED NEW THREAD FOR %s', worker_key, thread_key, address)
+        buffer = RequestBuffer(self.read_size)
+        served = 0
+        keep_alive = True
+        tracer = self.tracer
+        while keep_alive:
+            size = self._request_size(buffer)
+            if not size:
+                try:
+                    logging.debug('%s : THREAD %s : GETTING DATA', worker_key, thread_key)
+                    if served and not buffer:
+                        received = self._receive_next_request(client, buffer)
+                    else:
+                        client.settimeout(self.timeout)
+                        received = buffer.fill(client)
+                except OSError:
+                    received = 0
+                if not received:
+                    logging.debug('%s : THREAD %s : CLIENT DISCONNECTED, EXITING', worker_key, thread_key)
+                    break
+                logging.debug('%s : THREAD %s : RECEIVED %s BYTES', worker_key, thread_key, received)
+                if tracer is not None and trace is None:
+                    # a later request on the connection is timed from its first bytes, not the idle wait
+                    trace = tracer.begin()
+                continue
+            request = buffer.consume(size)
+            if tracer is not None:
+                trace = trace or tracer.begin()
+                trace.request = request
+                trace.mark('recv')
+            parts, keep_alive = self.handle_request(request, served + 1 < self.max_requests and not self.stopping,
+                                                    address, trace)
+            if isinstance(parts, Upload):
+                parts, keep_alive = self._receive_upload(client, buffer, parts)
+                if parts is None:
+                    break
+                if trace is not None:
+                    trace.mark('body')
+            served += 1
+            started = time.perf_counter()
+            try:
+                if not self._send_parts(client, parts):
+                    break
+            except OSError:
+                break
+            self.metrics.observe(PHASE_SEND, time.perf_counter() - started)
+            if trace is not None:
+                trace.mark('send')
+                self._finish_trace(trace, address)
+                trace = None
+            logging.debug('%s : THREAD %s : RESPONSE SENDED', worker_key, thread_key)
+        self.metrics.inc(CONNECTIONS_CLOSED)
+        self._release(address)
+        client.close()
+
+    def _receive_upload(self, client, buffer, upload) -> tuple:
+        """ Streams a request body into the upload, starting with the bytes already buffered
+            returns tuple: parts, keep_alive of the final response, parts is None if the client went away
+        """
+        try:
+            if upload.interim:
+                client.sendall(upload.interim)
+            if buffer:
+                buffer.consume(upload.feed(buffer.view[:len(buffer)]))
+            client.settimeout(self.timeout)
+            chunk = memoryview(bytearray(UPLOAD_CHUNK_SIZE))
+            while not upload.complete:
+                received = client.recv_into(chunk)
+                if not received:
+                    raise ConnectionError('client closed the connection inside the body')
+                consumed = upload.feed(chunk[:received])
+                if consumed < received and not buffer.append(chunk[consumed:received]):
+                    upload.keep_alive = False
+        except OSError as e:
+            logging.debug('UPLOAD TO %s FAILED: %s', upload.target, e)
+            upload.abort()
+            return None, False
+        return self.finish_upload(upload)
+
+    def _receive_next_request(self, client, buffer) -> int:
+        """ Receives on an idle persistent connection for up to the keep-alive timeout,
+            giving up early once the server drains or a new client waits while every worker is busy
+        """
+        idle_since = time.monotonic()
+        deadline = idle_since + self.keepalive_timeout
+        waiting = [client] + [sock for sock, _ in self.listeners]
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return 0
+            timeout = 0 if self.stopping else min(remaining, STOP_POLL_INTERVAL)
+            # decrypted bytes left in the TLS buffer do not make the socket readable
+            if timeout and not (isinstance(client, ssl.SSLSocket) and client.pending()):
+                try:
+                    readable, _, _ = select.select(waiting, [], [], timeout)
+                except (OSError, ValueError):
+                    return 0
+                if not readable:
+                    continue
+                if client not in readable:
+                    idle = time.monotonic() - idle_since
+                    if idle >= KEEPALIVE_YIELD_DELAY and self._claim_accept():
+                        logging.debug('NEW CLIENT WAITS AND NO WORKER IS FREE, CLOSING IDLE CONNECTION')
+                        return 0
+                    # a client sending requests back to back keeps its connection, and once another worker
+                    # takes the new client this one waits for its own client only
+                    wait = KEEPALIVE_YIELD_DELAY - idle if idle < KEEPALIVE_YIELD_DELAY else timeout
+                    readable, _, _ = select.select([client], [], [], wait)
+                    if not readable:
+                        continue
+            client.settimeout(timeout)
+            try:
+                return buffer.fill(client)
+            except (socket.timeout, BlockingIOError):
+                if self.stopping:
+                    return 0
+
+    @staticmethod
+    def _send_parts(client, parts) -> bool:
+        """ Sends response parts over a blocking socket, False if a file was cut short """
+        # TLS sockets take no send flags
+        more = 0 if isinstance(client, ssl.SSLSocket) else MSG_MORE
+        for i, part in enumerate(parts):
+            if isinstance(part, FileRegion):
+                with open(part.path, 'rb') as f:
+                    # socket.sendfile falls back to read/send itself where sendfile is unavailable or on TLS
+                    if client.sendfile(f, part.offset, part.count) < part.count:
+                        return False
+            else:
+                client.sendall(part, more if i + 1 < len(parts) else 0)
+        return True
+
+    def _before_workers_start(self):
+        """ Hook run in the process that is about to serve requests """
+        if self.mode == MODE_EVENTS and self.io_threads:
+            self.io_pool = ThreadPoolExecutor(self.io_threads, thread_name_prefix='io')
+        if self.tracer is not None:
+            self.tracer.start()
+
+    def _after_workers_stop(self):
+        """ Hook run on shutdown once the workers are joined """
+        if self.io_pool is not None:
+            self.io_pool.shutdown(wait=False)
+        if self.tracer is not None:
+            self.tracer.close()
+
+    def handle_request(self, data: bytes, can_keep_alive: bool, address=None, trace=None) -> tuple:
+        """ trace: RequestTrace to mark the phases of handling in, None unless tracing is enabled
+            returns tuple:
+                parts: list of bytes and FileRegion to send in order
+                keep_alive: bool, whether the connection may serve another request
+        """
+        return [self.get_response(data)], False
 
     def get_response(self, data: bytes) -> bytes:
         data = data.decode()
@@ -117,74 +1440,735 @@ class Server:
         else:
             return b'Unknown hello string'
 
-    def shutdown(self):
-        """ Shut down the server """
-        exit_code = 0
+    def shutdown(self, signum=None, frame=None):
+        """ Shut down the server gracefully, usable as a signal handler:
+            workers stop accepting, finish in-flight requests for up to drain_timeout seconds
+            and close idle persistent connections. A second call stops without waiting.
+        """
+        if self.stopping:
+            logging.info("Shutting down the server now")
+            self.drain_deadline = time.monotonic()
+            return
+        logging.info(f"Shutting down the server, draining connections for up to {self.drain_timeout} s")
+        self.drain_deadline = time.monotonic() + self.drain_timeout
+        self.stopping = True
+        for pid in self.children:
+            logging.info(f"STOPPING WORKER PROCESS {pid}")
+            os.kill(pid, signal.SIGTERM)
+
+
+class RequestBuffer:
+    """ Fixed-size per-connection buffer requests are received into without reallocation,
+        bytes left after a request are kept for the next pipelined one
+    """
+    __slots__ = ('data', 'view', 'length', 'scanned')
+
+    def __init__(self, capacity):
+        self.data = bytearray(capacity)
+        self.view = memoryview(self.data)
+        self.length = 0
+        self.scanned = 0
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def full(self) -> bool:
+        return self.length == len(self.data)
+
+    def fill(self, sock) -> int:
+        """ Receives into the free space, returns 0 when the peer closed the connection """
+        received = sock.recv_into(self.view[self.length:])
+        self.length += received
+        return received
+
+    def find(self, sub: bytes) -> int:
+        """ Finds sub in the buffered bytes, rescanning only what arrived since the last call """
+        start = max(self.scanned - len(sub) + 1, 0)
+        position = self.data.find(sub, start, self.length)
+        self.scanned = self.length if position == -1 else 0
+        return position
+
+    def append(self, data) -> bool:
+        """ Puts back bytes received past a request body, False if they do not fit """
+        if len(data) > len(self.data) - self.length:
+            return False
+        self.data[self.length:self.length + len(data)] = data
+        self.length += len(data)
+        return True
+
+    def consume(self, size) -> bytes:
+        """ Takes the first size bytes out of the buffer """
+        request = bytes(self.view[:size])
+        rest = self.length - size
+        if rest:
+            self.data[:rest] = bytes(self.view[size:self.length])
+        self.length = rest
+        self.scanned = 0
+        return request
+
+
+class Connection:
+    """ State of one client socket served by the event loop """
+    __slots__ = ('sock', 'address', 'inbuf', 'outparts', 'last_active', 'served', 'keep_alive', 'send_started',
+                 'pending', 'upload', 'tls', 'handshaking', 'trace', 'traces')
+
+    def __init__(self, sock, address, buffer_size, tls=False):
+        self.sock = sock
+        self.address = address
+        self.inbuf = RequestBuffer(buffer_size)
+        self.outparts = deque()
+        self.last_active = time.monotonic()
+        self.served = 0
+        self.keep_alive = True
+        self.send_started = 0.0
+        self.pending = None
+        self.upload = None
+        self.tls = tls
+        self.handshaking = tls
+        # request being received and responses being sent, while tracing
+        self.trace = None
+        self.traces = deque()
+
+
+class FileRegion:
+    """ Part of a file sent straight from the page cache instead of being read into memory """
+    __slots__ = ('path', 'offset', 'count', 'file', 'use_sendfile')
+
+    def __init__(self, path, offset, count):
+        self.path = path
+        self.offset = offset
+        self.count = count
+        self.file = None
+        self.use_sendfile = hasattr(os, 'sendfile')
+
+    def send_nonblocking(self, sock) -> int:
+        """ Sends the next chunk, returns bytes sent (0 at unexpected end of file)
+            or raises BlockingIOError when the socket buffer is full
+        """
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        size = min(self.count, SEND_CHUNK_SIZE)
+        if self.use_sendfile:
+            try:
+                sent = os.sendfile(sock.fileno(), self.file.fileno(), self.offset, size)
+            except BlockingIOError:
+                raise
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                    raise
+                logging.debug('SENDFILE UNAVAILABLE (%s), STREAMING %s', e, self.path)
+                self.use_sendfile = False
+        if not self.use_sendfile:
+            chunk = os.pread(self.file.fileno(), size, self.offset)
+            sent = sock.send(chunk) if chunk else 0
+        self.offset += sent
+        self.count -= sent
+        return sent
+
+    def read(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.count)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Upload:
+    """ Request body streamed into a temporary file beside the target and renamed over it once complete,
+        in constant memory for Content-Length and chunked bodies
+    """
+    SIZE, DATA, DATA_END, TRAILER, DONE = range(5)
+    MAX_LINE = 4096
+
+    def __init__(self, target, length, chunked, max_size, keep_alive):
+        self.target = target
+        self.max_size = max_size
+        self.chunked = chunked
+        self.keep_alive = keep_alive
+        self.remaining = 0 if chunked else length
+        self.state = self.SIZE if chunked else (self.DATA if length else self.DONE)
+        self.line = bytearray()
+        self.received = 0
+        self.error = ()
+        self.interim = None
+        self.request = None
+        self.created = not os.path.exists(target)
+        fd, self.temp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.upload-')
+        self.file = os.fdopen(fd, 'wb')
+
+    @property
+    def complete(self) -> bool:
+        return self.state == self.DONE or bool(self.error)
+
+    def feed(self, data) -> int:
+        """ Consumes body bytes from a memoryview, returns how many of them belong to the body """
+        consumed = 0
         try:
-            logging.info("Shutting down the server")
-            self.sock.shutdown(socket.SHUT_RDWR)
-            for th in threading.enumerate():
-                if th != threading.main_thread():
-                    logging.info(f"JOINING THREAD{th.name}")
-                    th.join(2)
-        except Exception as e:
-            logging.info(f"Warning: could not shut down the socket. Maybe it was already closed? {e}")
-            exit_code = 1
-        finally:
-            sys.exit(exit_code)
+            while consumed < len(data) and not self.complete:
+                if self.state == self.DATA:
+                    size = min(len(data) - consumed, self.remaining)
+                    self.file.write(data[consumed:consumed + size])
+                    consumed += size
+                    self.remaining -= size
+                    self.received += size
+                    if not self.remaining:
+                        self.state = self.DATA_END if self.chunked else self.DONE
+                    continue
+                window = bytes(data[consumed:consumed + self.MAX_LINE])
+                end = window.find(b'\n')
+                if end == -1:
+                    self.line += window
+                    consumed += len(window)
+                    if len(self.line) > self.MAX_LINE:
+                        raise ValueError('line too long')
+                    continue
+                self.line += window[:end + 1]
+                consumed += end + 1
+                line = bytes(self.line).strip()
+                self.line.clear()
+                self._on_line(line)
+        except ValueError as e:
+            self.error = (BAD_REQUEST, f'Malformed chunked body: {e}')
+        except OSError as e:
+            logging.error(f'Could not write upload for {self.target}: {e}')
+            self.error = (INTERNAL_SERVER_ERROR, 'Could not store the upload')
+        return consumed
+
+    def _on_line(self, line):
+        """ Chunk size line, the CRLF after chunk data or a trailer field """
+        if self.state == self.SIZE:
+            size = int(line.split(b';', 1)[0], 16)
+            if size < 0:
+                raise ValueError('negative chunk size')
+            if not size:
+                self.state = self.TRAILER
+            elif self.received + size > self.max_size:
+                self.error = (PAYLOAD_TOO_LARGE, f'Request body exceeds {self.max_size} bytes')
+            else:
+                self.remaining = size
+                self.state = self.DATA
+        elif self.state == self.DATA_END:
+            if line:
+                raise ValueError('no CRLF after chunk data')
+            self.state = self.SIZE
+        elif not line:
+            self.state = self.DONE
+
+    def finish(self) -> tuple:
+        """ Moves the received file into place, returns error tuple(code, text), empty on success """
+        if self.error:
+            self.abort()
+            return self.error
+        try:
+            self.file.close()
+            os.chmod(self.temp_path, 0o644)
+            os.replace(self.temp_path, self.target)
+        except OSError as e:
+            logging.error(f'Could not store upload for {self.target}: {e}')
+            self.abort()
+            return INTERNAL_SERVER_ERROR, 'Could not store the upload'
+        return ()
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+
+class CachedFile:
+    """ Contents and precomputed header values of a static file,
+        body is None for metadata-only entries (files over the per-entry limit, HEAD requests)
+    """
+    __slots__ = ('path', 'body', 'size', 'mtime', 'inode', 'content_type', 'etag', 'last_modified', 'checked_at')
+
+    def __init__(self, path, body, stat, etag_suffix='', content_type=None):
+        self.path = path
+        self.body = body
+        self.size = stat.st_size if body is None else len(body)
+        self.mtime = stat.st_mtime_ns
+        self.inode = stat.st_ino
+        self.content_type = content_type or mimetypes.guess_type(path)[0]
+        self.etag = f'"{self.mtime:x}-{stat.st_size:x}{etag_suffix}"'
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self.checked_at = time.monotonic()
+
+    @property
+    def weight(self):
+        return LRUCache.ENTRY_OVERHEAD + len(self.path) + (len(self.body) if self.body is not None else 0)
+
+
+class ResolvedPath:
+    """ Verdict of resolving a request path: the file to serve (status OK) or an error status,
+        error verdicts expire so that files created later are found.
+        A listing verdict points to a directory without index.html and expires too.
+    """
+    __slots__ = ('path', 'status', 'expires', 'listing')
+
+    def __init__(self, path, status, expires=float('inf'), listing=False):
+        self.path = path
+        self.status = status
+        self.expires = expires
+        self.listing = listing
+
+    @property
+    def weight(self):
+        return LRUCache.ENTRY_OVERHEAD + len(self.path)
+
+
+class DirectoryListing:
+    """ Entries of a directory as (name, is_dir, size, mtime) tuples, directories first and by name.
+        Kept in a FileCache, which rescans when the directory's mtime, inode or size change.
+    """
+    __slots__ = ('path', 'entries', 'orders', 'size', 'mtime', 'inode', 'etag', 'last_modified', 'checked_at',
+                 'weight')
+
+    def __init__(self, path):
+        self.path = path
+        st = os.stat(path)
+        entries = []
+        with os.scandir(path) as it:
+            for item in it:
+                if item.name.startswith('.'):
+                    continue
+                try:
+                    is_dir = item.is_dir()
+                    item_stat = item.stat()
+                except OSError:
+                    continue
+                entries.append((item.name, is_dir, 0 if is_dir else item_stat.st_size, int(item_stat.st_mtime)))
+        entries.sort(key=lambda item: (not item[1], item[0]))
+        self.entries = entries
+        self.orders = {('name', False): entries}
+        self.size = st.st_size
+        self.mtime = st.st_mtime_ns
+        self.inode = st.st_ino
+        self.etag = f'"d{self.mtime:x}-{len(entries):x}"'
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        self.checked_at = time.monotonic()
+        # charged up front for every sorted copy ordered() may add, a weight must not change while cached;
+        # the copies share the entry tuples and cost a list of pointers each
+        copies = 2 * len(LISTING_SORT_KEYS) - 1
+        self.weight = LRUCache.ENTRY_OVERHEAD + len(path) + sum(len(item[0]) + 100 for item in entries) + \
+            copies * (64 + 8 * len(entries))
+
+    def ordered(self, key, descending) -> list:
+        """ Entries sorted by name, size or mtime, each order computed once """
+        order = self.orders.get((key, descending))
+        if order is None:
+            order = sorted(self.entries, key=LISTING_SORT_KEYS[key], reverse=descending)
+            self.orders[key, descending] = order
+        return order
+
+
+class LRUCache:
+    """ Thread-safe LRU of entries with a weight property, bounded by total weight """
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return entry
+
+    def peek(self, key):
+        """ Entry without counting the lookup or refreshing its recency """
+        return self.entries.get(key)
+
+    def store(self, key, entry):
+        weight = entry.weight
+        if weight > self.max_size:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.weight
+            self.entries[key] = entry
+            self.size += weight
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.weight
+
+    def invalidate(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.weight
+
+
+class FileCache(LRUCache):
+    """ LRU of static files bounded by total and per-entry size.
+        An entry is revalidated against the file's mtime at most once per check_interval seconds.
+    """
+    def __init__(self, max_size, max_entry_size, check_interval=1.0):
+        super().__init__(max_size)
+        self.max_entry_size = max_entry_size
+        self.check_interval = check_interval
+        self.stale = 0
+
+    def get(self, path):
+        entry = super().get(path)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.checked_at < self.check_interval:
+            return entry
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        if stat is None or (stat.st_mtime_ns, stat.st_ino, stat.st_size) != (entry.mtime, entry.inode, entry.size):
+            logging.debug('CACHE ENTRY %s IS STALE', path)
+            self.stale += 1
+            self.invalidate(path)
+            return None
+        entry.checked_at = time.monotonic()
+        return entry
+
+    def put(self, entry):
+        if entry.body is not None and len(entry.body) > self.max_entry_size:
+            return
+        self.store(entry.path, entry)
+
+    def accepts(self, size) -> bool:
+        """ Whether contents of that size would be kept """
+        return size <= self.max_entry_size and size + self.ENTRY_OVERHEAD <= self.max_size
 
 
 def get_html_from_path(path):
     html = b''
     try:
-        logging.debug(f'TRY OPEN FILE: {path}')
+        logging.debug('TRY OPEN FILE: %s', path)
         with open(path, 'rb') as f:
             html = f.read()
     except Exception as e:
-        logging.debug(f"EXCEPTION {e}")
+        logging.debug("EXCEPTION %s", e)
     return html
 
 
-def gen_headers(code, content_length, content_type):
-    """ Generates HTTP response Headers."""
-    http_statuses = {
-        200: 'HTTP/1.1 200 OK\r\n',
-        404: 'HTTP/1.1 404 Not Found\r\n',
-        405: 'HTTP/1.1 405 Method Not Allowed\r\n',
-        403: 'HTTP/1.1 403 Forbidden\r\n'
-    }
+def parse_range(value: str, size: int):
+    """ Parses a Range header against a representation of the given size
+        returns:
+            None if the header is absent, malformed or asks for too many ranges (full response)
+            list of (start, end) inclusive byte positions, empty if nothing is satisfiable
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+    specs = spec.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for item in specs:
+        first, sep, last = item.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else start
+                if end < start:
+                    return None
+                if not last:
+                    end = size - 1
+            else:
+                suffix = int(last)
+                start, end = max(size - suffix, 0), size - 1
+                if suffix == 0:
+                    continue
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    return ranges
 
-    return f"{http_statuses[code]}" \
-           f"Date: {time.strftime('%a, %d %b %Y %H:%M:%S', time.localtime())}\r\n" \
-           f"Server: My-HTTP-Server\r\n" \
-           f"Connection: close\r\n" \
-           f"Content-Length: {content_length}\r\n" \
-           f"Content-Type: {content_type}\n\n"
+
+def parse_accept_encoding(value: str) -> dict:
+    """ Maps content codings of an Accept-Encoding header to their q-values """
+    codings = {}
+    for item in value.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def is_compressible(content_type) -> bool:
+    return bool(content_type) and (content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES)
+
+
+HTTP_STATUSES = {
+    200: 'OK',
+    201: 'Created',
+    204: 'No Content',
+    206: 'Partial Content',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    416: 'Range Not Satisfiable',
+    417: 'Expectation Failed',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+    503: 'Service Unavailable',
+    505: 'HTTP Version Not Supported',
+}
+# status line, Server and Connection headers for every (code, keep_alive)
+HEADER_PREFIXES = {
+    (code, keep_alive): f"HTTP/1.1 {code} {reason}\r\n"
+                        f"Server: My-HTTP-Server\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n".encode()
+    for code, reason in HTTP_STATUSES.items() for keep_alive in (False, True)
+}
+_content_type_lines = {}
+_date_line = (0, b'')
+
+
+def date_line() -> bytes:
+    """ Date header, formatted once per second """
+    global _date_line
+    now = int(time.time())
+    second, line = _date_line
+    if second != now:
+        line = f"Date: {formatdate(now, usegmt=True)}\r\n".encode()
+        _date_line = (now, line)
+    return line
+
+
+def gen_headers(code, content_length, content_type, keep_alive=False, extra_headers=None) -> bytes:
+    """ Generates HTTP response Headers.
+        Content-Length and Content-Type are omitted when None, extra_headers is a dict of additional ones.
+    """
+    parts = [HEADER_PREFIXES[code, keep_alive], date_line()]
+    if content_length is not None:
+        parts.append(b"Content-Length: %d\r\n" % content_length)
+    if content_type is not None:
+        line = _content_type_lines.get(content_type)
+        if line is None:
+            line = _content_type_lines[content_type] = f"Content-Type: {content_type}\r\n".encode()
+        parts.append(line)
+    if extra_headers:
+        parts.append(''.join(f"{key}: {value}\r\n" for key, value in extra_headers.items()).encode())
+    parts.append(b"\r\n")
+    return b''.join(parts)
+
+
+class Site:
+    """ Document root served for a virtual host, with its own index files, caches and MIME settings """
+    __slots__ = ('root', 'root_prefix', 'index_files', 'autoindex', 'max_ages', 'mime_types', 'paths', 'cache',
+                 'compressed', 'compressing', 'compress_lock', 'mapped', 'listings', 'cache_control', 'settings')
+
+    def __init__(self, document_root, index_files=('index.html',),
+                 cache_size=64 * 1024 * 1024, cache_entry_size=1024 * 1024, compress_cache_size=16 * 1024 * 1024,
+                 path_cache_size=4 * 1024 * 1024, mmap_cache_size=0, mmap_max_size=16 * 1024 * 1024,
+                 autoindex=False, autoindex_cache_size=8 * 1024 * 1024, max_ages=None, mime_types=None):
+        self.root = os.path.realpath(document_root)
+        self.root_prefix = os.path.join(self.root, '')
+        self.index_files = tuple(index_files)
+        self.autoindex = autoindex
+        self.max_ages = max_ages or {}
+        # extension: MIME type, taking precedence over the mimetypes module
+        self.mime_types = mime_types or {}
+        self.paths = LRUCache(path_cache_size)
+        self.cache = FileCache(cache_size, cache_entry_size)
+        self.compressed = LRUCache(compress_cache_size)
+        # variant key: Event set once the thread compressing it is done, others wait instead of compressing too
+        self.compressing = {}
+        self.compress_lock = threading.Lock()
+        # files too big for the cache above are mapped: no copy per response, pages shared with other processes
+        self.mapped = FileCache(mmap_cache_size, mmap_max_size) if mmap_cache_size else None
+        self.listings = FileCache(autoindex_cache_size, autoindex_cache_size)
+        self.cache_control = {}
+        self.settings = None
+
+    def content_type(self, path):
+        """ Overridden MIME type of a file, None to guess it, encoded siblings like .js.gz typed as the original """
+        if not self.mime_types:
+            return None
+        base, extension = os.path.splitext(path)
+        if extension in ('.gz', '.br'):
+            base, extension = os.path.splitext(base)
+        return self.mime_types.get(extension.lower())
+
+    def caches(self):
+        caches = [('file', self.cache), ('compressed', self.compressed), ('path', self.paths)]
+        if self.mapped is not None:
+            caches.append(('mmap', self.mapped))
+        if self.autoindex:
+            caches.append(('listing', self.listings))
+        return caches
 
 
 class HTTPServer(Server):
-    def __init__(self, host, port, workers, document_root):
+    def __init__(self, host, port, workers, document_root,
+                 cache_size=64 * 1024 * 1024, cache_entry_size=1024 * 1024,
+                 sendfile_threshold=64 * 1024, max_ages=None,
+                 compress_cache_size=16 * 1024 * 1024, max_header_size=8192, max_headers=100,
+                 path_cache_size=4 * 1024 * 1024, negative_ttl=1.0, metrics_path=None,
+                 access_log=None, access_log_format=ACCESS_LOG_COMBINED, access_log_queue=10000,
+                 mmap_cache_size=0, mmap_max_size=16 * 1024 * 1024,
+                 autoindex=False, autoindex_page_size=1000, autoindex_cache_size=8 * 1024 * 1024,
+                 preload=False, preload_budget=64 * 1024 * 1024, preload_include=None, preload_exclude=None,
+                 preload_compress=False, health_path=None, upload_path=None, max_body_size=1024 * 1024 * 1024,
+                 vhosts=None, **kwargs):
         self.document_root = document_root
+        # settings of virtual hosts default to those of the document root
+        self.site_defaults = {
+            'cache_size': cache_size,
+            'cache_entry_size': cache_entry_size,
+            'compress_cache_size': compress_cache_size,
+            'path_cache_size': path_cache_size,
+            'mmap_cache_size': mmap_cache_size,
+            'mmap_max_size': mmap_max_size,
+            'autoindex': autoindex,
+            'autoindex_cache_size': autoindex_cache_size,
+            'max_ages': max_ages or {},
+        }
+        # serves requests for hosts missing from the virtual hosts file
+        self.default_site = Site(document_root, **self.site_defaults)
+        self.vhosts = vhosts
+        self.vhosts_mtime = None
+        self.sites = {}
+        if vhosts:
+            try:
+                self._load_sites()
+            except (OSError, ValueError) as e:
+                logging.info(f"ERROR: Failed to load virtual hosts from {vhosts}: {e}")
+                sys.exit(1)
+        self.negative_ttl = negative_ttl
+        self.metrics_path = metrics_path
+        self.access_log = AccessLog(access_log, access_log_format, access_log_queue) if access_log else None
+        self._status_keys = {}
+        self.autoindex_page_size = autoindex_page_size
+        self.preload = preload
+        self.preload_budget = preload_budget
+        self.preload_include = preload_include or ['*']
+        self.preload_exclude = preload_exclude or []
+        self.preload_compress = preload_compress
+        self.health_path = health_path
+        # uploads go below the prefix only, matched on whole path segments
+        self.upload_path = posixpath.join('/', upload_path.strip('/'), '') if upload_path else None
+        self.max_body_size = max_body_size
+        self.ready = threading.Event()
+        self.encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+        self.sendfile_threshold = sendfile_threshold
         self.delimiter = b'\r\n'
         self.ender = b'\r\n\r\n'
         self.close_connection = True
-        super().__init__(host, port, workers)
+        self.max_headers = max_headers
+        super().__init__(host, port, workers, **kwargs)
+        self.read_size = max_header_size
+
+    def _load_sites(self):
+        """ Reads the virtual hosts file and switches to its hosts at once,
+            hosts whose settings did not change keep their warm caches
+        """
+        self.vhosts_mtime = os.stat(self.vhosts).st_mtime_ns
+        previous = {site.settings: site for site in self.sites.values()}
+        sites = {}
+        for names, settings in load_vhosts(self.vhosts):
+            key = json.dumps(settings, sort_keys=True)
+            site = previous.get(key)
+            if site is None:
+                site = Site(**dict(self.site_defaults, **settings))
+                site.settings = key
+            for name in names:
+                sites[name] = site
+        self.sites = sites
+        logging.info(f"Serving {len(set(map(id, sites.values())))} virtual hosts from {self.vhosts}")
+
+    def _watch_vhosts(self):
+        """ Applies changes of the virtual hosts file without a restart, a broken file keeps the previous hosts """
+        while not self.stopping:
+            time.sleep(VHOSTS_CHECK_INTERVAL)
+            try:
+                if os.stat(self.vhosts).st_mtime_ns == self.vhosts_mtime:
+                    continue
+                self._load_sites()
+            except (OSError, ValueError) as e:
+                logging.error(f"Keeping the previous virtual hosts, could not load {self.vhosts}: {e}")
+                try:
+                    self.vhosts_mtime = os.stat(self.vhosts).st_mtime_ns
+                except OSError:
+                    pass
+
+    def _site_for(self, host: str) -> Site:
+        """ Site of a Host header value, the port stripped """
+        if not self.sites:
+            return self.default_site
+        host = host.lower()
+        if not host.endswith(']'):
+            host = host.rpartition(':')[0] or host
+        return self.sites.get(host, self.default_site)
+
+    def _all_sites(self) -> list:
+        return [self.default_site] + list({id(site): site for site in self.sites.values()}.values())
+
+    def _request_size(self, buffer) -> int:
+        end = buffer.find(self.ender)
+        if end != -1:
+            return end + len(self.ender)
+        if buffer.full:
+            # header block does not fit, _get_headers answers it with 431
+            return len(buffer)
+        return 0
+
+    @staticmethod
+    def _keep_alive(headers: dict) -> bool:
+        """ HTTP/1.1 connections persist unless closed explicitly, HTTP/1.0 ones only on request """
+        connection = headers.get('connection', '').lower()
+        if headers['version'] == 'HTTP/1.1':
+            return 'close' not in connection
+        return 'keep-alive' in connection
 
     def _get_headers(self, data):
-        """Only \r\n delimiter syntax is supported
+        """Only \r\n delimiter syntax is supported, header names are lowercased
            returns tuple:
                 headers: dict (empty if error while parsing headers
                 error: tuple(error_code, error_str) (empty if parsed without an error)
         """
+        if not data.endswith(self.ender):
+            return dict(), (REQUEST_HEADER_FIELDS_TOO_LARGE,
+                            "Request header block exceeds %d bytes" % self.read_size)
+        lines = data[:-len(self.ender)].split(self.delimiter)
+        if len(lines) - 1 > self.max_headers:
+            return dict(), (REQUEST_HEADER_FIELDS_TOO_LARGE, "More than %d header fields" % self.max_headers)
         headers = dict()
-        headersline = str(data, 'iso-8859-1')
-        headersline = headersline.rstrip('\r\n')
-        headerslist = headersline.split('\r\n')
-        try:
-            firstline, add_headers = headerslist[0], headerslist[1:]
-            words = firstline.split()
-        except Exception:
-            return dict(), (BAD_REQUEST, "Bad request syntax (%r)" % headersline)
+        for line in lines[1:]:
+            key, sep, value = line.partition(b':')
+            if not sep or not key or key[:1].isspace() or key[-1:].isspace():
+                return dict(), (BAD_REQUEST, "Bad header line (%r)" % line)
+            headers[key.decode('iso-8859-1').lower()] = value.strip().decode('iso-8859-1')
+        words = lines[0].decode('iso-8859-1').split()
         command, path, version = '', '', ''
         if len(words) == 3:
             command, path, version = words
@@ -194,10 +2178,7 @@ class HTTPServer(Server):
         headers['command'] = command
         headers['path'] = path
         headers['version'] = version
-        for line in add_headers:
-            key, value = line.split(': ')
-            headers[key] = value
-        logging.debug(f'HEADERS: {headers}')
+        logging.debug('HEADERS: %s', headers)
 
         if headers['version']:
             version = headers['version']
@@ -213,73 +2194,902 @@ class HTTPServer(Server):
                 return dict(), (BAD_REQUEST, "Bad request version (%r)" % version)
             if version_number >= (2, 0):
                 return dict(), (HTTP_VERSION_NOT_SUPPORTED, "Invalid HTTP version (%s)" % base_version_number)
+        if headers['command'] in ['PUT', 'POST'] and self.upload_path:
+            return headers, tuple()
         if headers['command'] not in ['GET', 'HEAD']:
             return dict(), (NOT_ALLOWED, "Method not allowed: (%r)" % headers['command'])
+        if headers.get('transfer-encoding') or headers.get('content-length', '0') != '0':
+            return dict(), (PAYLOAD_TOO_LARGE, "Request body is not accepted for %s" % headers['command'])
 
         return headers, tuple()
 
-    def _resolve_path(self, path: str) -> tuple:
-        logging.debug(f'PATH GETTED {path}')
-        query = ''
-        if '?' in path:
-            path, query = path.split('?')
+    def _start_upload(self, site, headers, keep_alive):
+        """ Checks an upload request, returns Upload to stream its body into or an error response """
+        url_path = unquote(headers['path'].partition('?')[0])
+        if '..' in url_path.split('/') or '\0' in url_path:
+            return self._error_response(FORBIDDEN, 'Access denied')
+        normalized = posixpath.normpath(url_path)
+        if not normalized.startswith(self.upload_path):
+            return self._error_response(NOT_ALLOWED, f"Uploads are accepted under {self.upload_path}")
+        if url_path.endswith('/'):
+            return self._error_response(NOT_ALLOWED, "Uploads must name a file")
+        transfer_encoding = headers.get('transfer-encoding', '').lower()
+        if transfer_encoding and transfer_encoding != 'chunked':
+            return self._error_response(NOT_IMPLEMENTED, f"Transfer-Encoding {transfer_encoding} is not supported")
+        chunked = transfer_encoding == 'chunked'
+        length = None
+        if not chunked:
+            if 'content-length' not in headers:
+                return self._error_response(LENGTH_REQUIRED, "Content-Length or chunked body is required")
+            try:
+                length = int(headers['content-length'])
+                if length < 0:
+                    raise ValueError
+            except ValueError:
+                return self._error_response(BAD_REQUEST, "Bad Content-Length")
+            if length > self.max_body_size:
+                return self._error_response(PAYLOAD_TOO_LARGE, f"Request body exceeds {self.max_body_size} bytes")
+        expect = headers.get('expect', '').lower()
+        if expect and expect != '100-continue':
+            return self._error_response(EXPECTATION_FAILED, f"Unsupported expectation {expect}")
+        target, error = self._upload_target(site, normalized)
+        if error:
+            return self._error_response(*error)
+        try:
+            upload = Upload(target, length, chunked, self.max_body_size, keep_alive)
+        except OSError as e:
+            logging.error(f"Could not start upload to {target}: {e}")
+            return self._error_response(INTERNAL_SERVER_ERROR, "Could not store the upload")
+        if expect:
+            upload.interim = CONTINUE_RESPONSE
+        return upload, keep_alive
+
+    def _upload_target(self, site, url_path) -> tuple:
+        """ File path an upload is stored at, creating missing directories inside the upload directory
+            url_path: unquoted and normalized request path below the upload prefix
+            returns tuple: path, error tuple(code, text) or empty
+        """
+        upload_prefix = os.path.join(os.path.realpath(os.path.join(site.root, self.upload_path.strip('/'))), '')
+        target = os.path.normpath(os.path.join(site.root, url_path.lstrip('/')))
+        if not target.startswith(site.root_prefix):
+            return '', (FORBIDDEN, 'Access denied')
+        directory = os.path.dirname(target)
+        existing = directory
+        while not os.path.isdir(existing):
+            existing = os.path.dirname(existing)
+        # a symlinked directory must not lead the upload or the directories created for it out of the upload
+        # directory, only the upload directory itself and its parents may still be missing
+        existing = os.path.join(os.path.realpath(existing), '')
+        if not existing.startswith(upload_prefix) and not upload_prefix.startswith(existing):
+            return '', (FORBIDDEN, 'Access denied')
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            return '', (FORBIDDEN, 'Could not create the directory')
+        target = os.path.join(os.path.realpath(directory), os.path.basename(target))
+        if not target.startswith(upload_prefix):
+            return '', (FORBIDDEN, 'Access denied')
+        if os.path.isdir(target):
+            return '', (FORBIDDEN, 'A directory exists at this path')
+        return target, ()
+
+    @staticmethod
+    def _invalidate(site, path, url_path):
+        """ Drops what the caches of this process know about a changed file,
+            other processes notice it when they revalidate
+        """
+        site.paths.invalidate(url_path)
+        site.cache.invalidate(path)
+        if site.mapped is not None:
+            site.mapped.invalidate(path)
+        site.listings.invalidate(os.path.dirname(path))
+
+    def _resolve_path(self, site, path: str) -> tuple:
+        """ returns tuple: ResolvedPath, query """
+        path, _, query = path.partition('?')
+        resolved = site.paths.get(path)
+        if resolved is None or resolved.expires < time.monotonic():
+            resolved = self._resolve_uncached(site, path)
+            site.paths.store(path, resolved)
+        return resolved, query
+
+    def _resolve_uncached(self, site, path: str) -> ResolvedPath:
+        logging.debug('PATH GETTED %s', path)
         if '%' in path:
             path = unquote(path)
-        if path == '/':
-            path = os.path.join(self.document_root, 'index.html')
+        not_found = ResolvedPath('', NOT_FOUND, time.monotonic() + self.negative_ttl)
+        try:
+            candidate = os.path.join(site.root, path.lstrip('/'))
+            if os.path.isdir(candidate):
+                directory = candidate
+                indexes = [os.path.join(directory, name) for name in site.index_files]
+                candidate = next((index for index in indexes if os.path.exists(index)), indexes[0])
+                if site.autoindex and not os.path.exists(candidate):
+                    directory = os.path.realpath(directory)
+                    if not os.path.join(directory, '').startswith(site.root_prefix):
+                        return ResolvedPath('', FORBIDDEN, not_found.expires)
+                    return ResolvedPath(directory, OK, not_found.expires, listing=True)
+            elif path.endswith('/'):
+                return not_found
+            candidate = os.path.realpath(candidate)
+            if not candidate.startswith(site.root_prefix):
+                return ResolvedPath('', FORBIDDEN, not_found.expires)
+            if not S_ISREG(os.stat(candidate).st_mode):
+                return not_found
+        except (OSError, ValueError):
+            return not_found
+        logging.debug('RESOLVED PATH: %s', candidate)
+        return ResolvedPath(candidate, OK)
+
+    def _get_file(self, site, path, with_body=True):
+        """ Returns CachedFile for a regular file, reading its contents only when they are needed
+            and fit into the cache, or None if there is no such file
+        """
+        entry = site.cache.get(path)
+        if entry is not None and (entry.body is not None or not with_body or not site.cache.accepts(entry.size)):
+            if entry.body is None and with_body and site.mapped is not None and site.mapped.accepts(entry.size):
+                return self._get_mapped(site, path) or entry
+            return entry
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not S_ISREG(st.st_mode):
+            return None
+        body = None
+        if with_body and site.cache.accepts(st.st_size):
+            body = get_html_from_path(path)
+        entry = CachedFile(path, body, st, content_type=site.content_type(path))
+        site.cache.put(entry)
+        if body is None and with_body and site.mapped is not None and site.mapped.accepts(st.st_size):
+            return self._get_mapped(site, path) or entry
+        return entry
+
+    @staticmethod
+    def _get_mapped(site, path):
+        """ Returns CachedFile with the body in a shared read-only mapping of the file.
+            Responses hold memoryview slices of it, so a replaced file stays mapped until they are sent.
+        """
+        entry = site.mapped.get(path)
+        if entry is not None:
+            return entry
+        try:
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if not st.st_size:
+                    return None
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            logging.debug('COULD NOT MAP %s: %s', path, e)
+            return None
+        if hasattr(mapping, 'madvise'):
+            mapping.madvise(mmap.MADV_WILLNEED)
+        entry = CachedFile(path, memoryview(mapping), st, content_type=site.content_type(path))
+        site.mapped.put(entry)
+        return entry
+
+    def _negotiate_encoding(self, site, headers, entry, head):
+        """ Picks the representation for Accept-Encoding
+            returns tuple:
+                entry: CachedFile of the original or an encoded variant
+                encoding: content coding of that entry, empty for identity
+                vary: whether the response depends on Accept-Encoding
+        """
+        compressible = is_compressible(entry.content_type)
+        accepted = parse_accept_encoding(headers.get('accept-encoding', ''))
+        preferences = [(accepted.get(enc, accepted.get('*', 0)), -i, enc) for i, enc in enumerate(self.encodings)]
+        for q, _, encoding in sorted(preferences, reverse=True):
+            if q <= 0:
+                break
+            sibling = self._encoded_sibling(site, entry, encoding, head)
+            if sibling is not None:
+                return sibling, encoding, True
+            if not compressible or entry.size < MIN_COMPRESS_SIZE:
+                continue
+            variant = self._compressed_variant(site, entry, encoding, head)
+            if variant is not None:
+                return variant, encoding, True
+        return entry, '', compressible
+
+    def _encoded_sibling(self, site, entry, encoding, head):
+        """ Precompressed .gz/.br file next to the entry if it is up to date.
+            A missing one is remembered in the path cache for negative_ttl, keyed by the entry version.
+        """
+        key = (entry.path, entry.mtime, encoding)
+        missing = site.paths.peek(key)
+        if missing is not None and missing.expires >= time.monotonic():
+            return None
+        sibling = self._get_file(site, entry.path + ENCODING_SUFFIXES[encoding], with_body=not head)
+        if sibling is None:
+            site.paths.store(key, ResolvedPath('', NOT_FOUND, time.monotonic() + self.negative_ttl))
+            return None
+        return sibling if sibling.mtime >= entry.mtime else None
+
+    def _compressed_variant(self, site, entry, encoding, head):
+        """ Compresses the file once per version, HEAD only uses variants compressed before.
+            Concurrent misses on one variant wait for the first thread to compress it.
+        """
+        key = (entry.path, entry.mtime, encoding)
+        variant = site.compressed.get(key)
+        if variant is not None or head or not site.compressed.max_size or not site.cache.accepts(entry.size):
+            return variant
+        with site.compress_lock:
+            done = site.compressing.get(key)
+            compressing = done is None
+            if compressing:
+                done = site.compressing[key] = threading.Event()
+        if not compressing:
+            done.wait()
+            return site.compressed.peek(key)
+        try:
+            return self._compress(site, entry, encoding, key)
+        finally:
+            with site.compress_lock:
+                del site.compressing[key]
+            done.set()
+
+    @staticmethod
+    def _compress(site, entry, encoding, key):
+        body = entry.body if entry.body is not None else get_html_from_path(entry.path)
+        if len(body) != entry.size:
+            return None
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=BROTLI_QUALITY)
+        else:
+            compressed = gzip.compress(body, mtime=0)
+        try:
+            st = os.stat(entry.path)
+        except OSError:
+            return None
+        if st.st_mtime_ns != entry.mtime:
+            return None
+        variant = CachedFile(entry.path, compressed, st, etag_suffix=f'-{encoding}', content_type=entry.content_type)
+        site.compressed.store(key, variant)
+        return variant
+
+    @staticmethod
+    def _cache_control_for(site, content_type):
+        """ Cache-Control value for a MIME type: exact max_ages key, then 'type/*', then '*' """
+        try:
+            return site.cache_control[content_type]
+        except KeyError:
+            pass
+        major = (content_type or '').split('/')[0]
+        for key in (content_type, f'{major}/*', '*'):
+            if key in site.max_ages:
+                value = f'max-age={site.max_ages[key]}'
+                break
         else:
-            path = self.document_root + path
-        if os.path.isdir(path):
-            path = os.path.join(path, 'index.html')  # 'htm' extension is not supported
-        if DOCUMENT_ROOT not in os.path.abspath(path):
-            return '', ''
-        logging.debug(f'RESOLVED PATH: {path}')
-        return path, query
+            value = None
+        site.cache_control[content_type] = value
+        return value
+
+    @staticmethod
+    def _not_modified(headers, entry) -> bool:
+        """ If-None-Match takes precedence over If-Modified-Since (RFC 7232, 6) """
+        if_none_match = headers.get('if-none-match', '')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or any((tag[2:] if tag.startswith('W/') else tag) == entry.etag for tag in tags)
+        if_modified_since = headers.get('if-modified-since', '')
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return entry.mtime // 1_000_000_000 <= since
+        return False
+
+    @staticmethod
+    def _if_range_matches(headers, entry) -> bool:
+        if_range = headers.get('if-range', '')
+        if not if_range:
+            return True
+        if if_range.startswith('"'):
+            return if_range == entry.etag
+        return if_range == entry.last_modified
+
+    def _body_part(self, entry, start, length):
+        """ Slice of the cached body or a file region, never reading the file into memory """
+        if entry.body is not None:
+            return memoryview(entry.body)[start:start + length]
+        return FileRegion(entry.path, start, length)
+
+    def _ranged_response(self, entry, ranges, head, keep_alive, extra_headers):
+        """ 206 response with a single range or multipart/byteranges """
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            extra_headers['Content-Range'] = f'bytes {start}-{end}/{entry.size}'
+            response_headers = gen_headers(PARTIAL_CONTENT, end - start + 1, entry.content_type,
+                                           keep_alive, extra_headers)
+            if head:
+                return [response_headers]
+            return [response_headers, self._body_part(entry, start, end - start + 1)]
+
+        boundary = uuid.uuid4().hex
+        content_type = entry.content_type or 'application/octet-stream'
+        body, length = [], 0
+        for start, end in ranges:
+            part_headers = f'\r\n--{boundary}\r\n' \
+                           f'Content-Type: {content_type}\r\n' \
+                           f'Content-Range: bytes {start}-{end}/{entry.size}\r\n\r\n'.encode()
+            body += [part_headers, self._body_part(entry, start, end - start + 1)]
+            length += len(part_headers) + end - start + 1
+        closing = f'\r\n--{boundary}--\r\n'.encode()
+        body.append(closing)
+        length += len(closing)
+        response_headers = gen_headers(PARTIAL_CONTENT, length, f'multipart/byteranges; boundary={boundary}',
+                                       keep_alive, extra_headers)
+        return [response_headers] if head else [response_headers] + body
+
+    @staticmethod
+    def _get_listing(site, path):
+        listing = site.listings.get(path)
+        if listing is None:
+            try:
+                listing = DirectoryListing(path)
+            except OSError:
+                return None
+            site.listings.store(path, listing)
+        return listing
+
+    def _listing_response(self, site, headers, directory, query, keep_alive):
+        """ One page of the directory listing as HTML or, with format=json in the query, JSON """
+        listing = self._get_listing(site, directory)
+        if listing is None:
+            return self._error_response(NOT_FOUND, 'Page not found', keep_alive)
+        validators = {'ETag': listing.etag, 'Last-Modified': listing.last_modified}
+        if self._not_modified(headers, listing):
+            return [gen_headers(NOT_MODIFIED, None, None, keep_alive, validators)], keep_alive
+        params = parse_qs(query)
+        sort = params.get('sort', ['name'])[0]
+        if sort not in LISTING_SORT_KEYS:
+            sort = 'name'
+        descending = params.get('order', [''])[0] == 'desc'
+        entries = listing.ordered(sort, descending)
+        pages = max((len(entries) + self.autoindex_page_size - 1) // self.autoindex_page_size, 1)
+        try:
+            page = min(max(int(params.get('page', ['1'])[0]), 1), pages)
+        except ValueError:
+            page = 1
+        first = (page - 1) * self.autoindex_page_size
+        entries = entries[first:first + self.autoindex_page_size]
+        url_path = headers['path'].partition('?')[0]
+        if not url_path.endswith('/'):
+            url_path += '/'
+        if params.get('format', [''])[0] == 'json':
+            body = json.dumps({
+                'path': unquote(url_path),
+                'page': page,
+                'pages': pages,
+                'total': len(listing.entries),
+                'entries': [{'name': name, 'type': 'directory' if is_dir else 'file', 'size': size, 'mtime': mtime}
+                            for name, is_dir, size, mtime in entries],
+            }).encode()
+            content_type = 'application/json'
+        else:
+            body = self._listing_html(url_path, entries, page, pages, sort, descending).encode()
+            content_type = 'text/html; charset=utf-8'
+        response_headers = gen_headers(OK, len(body), content_type, keep_alive, validators)
+        if headers['command'] == 'HEAD':
+            return [response_headers], keep_alive
+        return [response_headers, body], keep_alive
+
+    @staticmethod
+    def _listing_html(url_path, entries, page, pages, sort, descending) -> str:
+        # links are absolute: the directory may have been requested without the trailing slash
+        parent = url_path[:-1].rpartition('/')[0] + '/'
+        rows = [HTML_LISTING_HEAD.format(path=html.escape(unquote(url_path)), parent=html.escape(parent))]
+        for name, is_dir, size, mtime in entries:
+            href = html.escape(url_path + quote(name) + ('/' if is_dir else ''))
+            label = html.escape(name) + ('/' if is_dir else '')
+            rows.append(f'<tr><td><a href="{href}">{label}</a></td><td>{"-" if is_dir else size}</td>'
+                        f'<td>{formatdate(mtime, usegmt=True)}</td></tr>\n')
+        rows.append('</table>\n')
+        if pages > 1:
+            order = '&order=desc' if descending else ''
+            if page > 1:
+                rows.append(f'<a href="?sort={sort}{order}&page={page - 1}">&larr; previous</a> ')
+            rows.append(f'page {page} of {pages}')
+            if page < pages:
+                rows.append(f' <a href="?sort={sort}{order}&page={page + 1}">next &rarr;</a>')
+            rows.append('\n')
+        rows.append('</body>\n</html>\n')
+        return ''.join(rows)
 
     def get_response(self, data):
+        parts, _ = self.handle_request(data, False)
+        return b''.join(p.read() if isinstance(p, FileRegion) else p for p in parts)
+
+    @staticmethod
+    def _error_response(status, text, keep_alive=False):
+        html_err = HTML_ERROR.format(status=status, text=text).encode()
+        return [gen_headers(status, len(html_err), 'text/html', keep_alive) + html_err], keep_alive
+
+    def handle_request(self, data, can_keep_alive, address=None, trace=None):
+        if trace is not None and trace.sampled:
+            return self.tracer.profile(trace, self._handle_request, data, can_keep_alive, address, trace)
+        return self._handle_request(data, can_keep_alive, address, trace)
+
+    def _handle_request(self, data, can_keep_alive, address, trace):
+        shard = self.metrics.shard()
+        started = time.perf_counter()
         headers, error = self._get_headers(data)
+        shard.observe(PHASE_PARSE, time.perf_counter() - started)
+        if trace is not None:
+            trace.mark('parse')
         if error:
-            status, text = error
-            html_err = HTML_ERROR.format(status=status, text=text).encode() + b'\r\n\r\n'
-            return gen_headers(status, len(html_err), 'text/html').encode() + html_err
-        path, query = self._resolve_path(headers['path'])
-        content_type, _ = mimetypes.guess_type(path)
+            parts, keep_alive = self._error_response(*error)
+        else:
+            parts, keep_alive = self._handle(headers, can_keep_alive, shard, trace)
+        if isinstance(parts, Upload):
+            # counted and logged by finish_upload once the body is in
+            parts.request = (data, headers, address, started)
+            return parts, keep_alive
+        self._record(shard, parts, data, headers, address, started)
+        if trace is not None:
+            trace.mark('respond')
+        return parts, keep_alive
 
-        if headers['command'] == 'HEAD':
-            return gen_headers(OK, len(get_html_from_path(path)), content_type).encode() + b'\r\n\r\n'
+    def finish_upload(self, upload):
+        data, headers, address, started = upload.request
+        error = upload.finish()
+        if error:
+            parts, keep_alive = self._error_response(*error)
+        else:
+            url_path = headers['path'].partition('?')[0]
+            self._invalidate(self._site_for(headers.get('host', '')), upload.target, url_path)
+            keep_alive = upload.keep_alive
+            if upload.created:
+                parts = [gen_headers(CREATED, 0, None, keep_alive, {'Location': url_path})]
+            else:
+                parts = [gen_headers(NO_CONTENT, None, None, keep_alive)]
+        self._record(self.metrics.shard(), parts, data, headers, address, started)
+        return parts, keep_alive
+
+    def _record(self, shard, parts, data, headers, address, started):
+        """ Counts the response in the metrics and the access log """
+        duration = time.perf_counter() - started
+        shard.observe(REQUEST_SECONDS, duration)
+        status = parts[0][9:12]
+        key = self._status_keys.get(status)
+        if key is None:
+            key = self._status_keys[status] = ('httpd_requests_total', (('code', status.decode()),))
+        shard.inc(key)
+        sent = sum(p.count if isinstance(p, FileRegion) else len(p) for p in parts)
+        shard.inc(RESPONSE_BYTES, sent)
+        if self.access_log is not None:
+            self.access_log.log(address, data, headers, int(status), sent, duration)
+
+    def _before_workers_start(self):
+        super()._before_workers_start()
+        if self.access_log is not None:
+            self.access_log.start()
+        if self.vhosts:
+            threading.Thread(target=self._watch_vhosts, name='vhosts', daemon=True).start()
+        if self.preload:
+            threading.Thread(target=self._preload, name='preload', daemon=True).start()
+        else:
+            self.ready.set()
+
+    def _preload(self):
+        """ Warms the path, file and compressed caches from the document roots within the byte budget,
+            then reports readiness on the health endpoint
+        """
+        started = time.monotonic()
+        mimetypes.init()
+        budget = self.preload_budget
+        files = 0
+        for site in self._all_sites():
+            for directory, dirnames, filenames in os.walk(site.root):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if self.stopping:
+                        return
+                    relative = os.path.relpath(os.path.join(directory, name), site.root).replace(os.sep, '/')
+                    if not any(fnmatch.fnmatch(relative, pattern) for pattern in self.preload_include) or \
+                            any(fnmatch.fnmatch(relative, pattern) for pattern in self.preload_exclude):
+                        continue
+                    if name in site.index_files:
+                        self._resolve_path(site, '/' + quote(relative[:-len(name)]))
+                    resolved, _ = self._resolve_path(site, '/' + quote(relative))
+                    if resolved.status != OK or resolved.listing:
+                        continue
+                    entry = self._get_file(site, resolved.path, with_body=budget > 0)
+                    if entry is None:
+                        continue
+                    files += 1
+                    if entry.body is not None:
+                        budget -= entry.size
+                    if not self.preload_compress or not is_compressible(entry.content_type) or \
+                            entry.size < MIN_COMPRESS_SIZE:
+                        continue
+                    for encoding in self.encodings:
+                        variant = self._compressed_variant(site, entry, encoding, False)
+                        if variant is not None:
+                            budget -= variant.size
+        logging.info(f"Preloaded {files} files, {self.preload_budget - budget} bytes in "
+                     f"{time.monotonic() - started:.2f} s")
+        self.ready.set()
+
+    def _health_response(self, keep_alive):
+        """ 200 once the caches are warm, 503 while preloading or draining """
+        if self.stopping:
+            status, body = SERVICE_UNAVAILABLE, b'draining\n'
+        elif not self.ready.is_set():
+            status, body = SERVICE_UNAVAILABLE, b'warming up\n'
+        else:
+            status, body = OK, b'ok\n'
+        return [gen_headers(status, len(body), 'text/plain', keep_alive, {'Cache-Control': 'no-store'}) + body], \
+            keep_alive
+
+    def _after_workers_stop(self):
+        super()._after_workers_stop()
+        if self.access_log is not None:
+            self.access_log.close()
+
+    def _needs_io(self, request) -> bool:
+        """ Predicts a blocking stat or read from the caches, peeking without counting lookups.
+            Uploads always go to the pool: they create directories and a temporary file.
+        """
+        method, _, rest = request.partition(b' ')
+        path = rest.partition(b' ')[0].decode('iso-8859-1').partition('?')[0]
+        if method in (b'PUT', b'POST'):
+            return self.upload_path is not None and path.startswith(self.upload_path)
+        if method not in (b'GET', b'HEAD'):
+            return False
+        if path == self.metrics_path or path == self.health_path:
+            return False
+        site = self.default_site
+        lowered = request.lower()
+        if self.sites:
+            start = lowered.find(b'\r\nhost:')
+            if start != -1:
+                end = request.find(b'\r\n', start + 7)
+                site = self._site_for(request[start + 7:end].decode('iso-8859-1').strip())
+        now = time.monotonic()
+        resolved = site.paths.peek(path)
+        if resolved is None or resolved.expires < now:
+            return True
+        if resolved.status != OK:
+            return False
+        cache = site.listings if resolved.listing else site.cache
+        entry = cache.peek(resolved.path)
+        if entry is None or now - entry.checked_at >= cache.check_interval:
+            return True
+        if not resolved.listing and b'\r\naccept-encoding:' in lowered and \
+                self._encoding_needs_io(site, entry, method, now):
+            return True
+        if resolved.listing or entry.body is not None or method == b'HEAD':
+            return False
+        if site.mapped is not None and site.mapped.accepts(entry.size):
+            mapped = site.mapped.peek(resolved.path)
+            return mapped is None or now - mapped.checked_at >= site.mapped.check_interval
+        return entry.size < self.sendfile_threshold
+
+    def _encoding_needs_io(self, site, entry, method, now) -> bool:
+        """ Whether negotiating Accept-Encoding could stat an encoded sibling or compress the file """
+        compress = method == b'GET' and is_compressible(entry.content_type) and entry.size >= MIN_COMPRESS_SIZE \
+            and site.compressed.max_size and site.cache.accepts(entry.size)
+        for encoding in self.encodings:
+            key = (entry.path, entry.mtime, encoding)
+            missing = site.paths.peek(key)
+            if missing is None or missing.expires < now:
+                sibling = site.cache.peek(entry.path + ENCODING_SUFFIXES[encoding])
+                if sibling is None or now - sibling.checked_at >= site.cache.check_interval:
+                    return True
+                if sibling.mtime >= entry.mtime:
+                    continue
+            if compress and site.compressed.peek(key) is None:
+                return True
+        return False
+
+    def _metrics_response(self, keep_alive):
+        active = self.metrics.total(CONNECTIONS_TOTAL) - self.metrics.total(CONNECTIONS_CLOSED)
+        samples = [('httpd_connections_active', 'gauge', (), active)]
+        if self.max_connections:
+            samples.append(('httpd_connections_limit', 'gauge', (), self.max_connections))
+        samples.append(('httpd_ready', 'gauge', (), int(self.ready.is_set() and not self.stopping)))
+        if self.io_pool is not None:
+            samples.append(('httpd_io_pending', 'gauge', (), self.io_pending))
+        # summed over the virtual hosts
+        sizes, hits, misses = {}, {}, {}
+        for name, cache in self._caches():
+            sizes[name] = sizes.get(name, 0) + cache.size
+            hits[name] = hits.get(name, 0) + cache.hits
+            misses[name] = misses.get(name, 0) + cache.misses
+        samples += [('httpd_cache_bytes', 'gauge', (('cache', name),), size) for name, size in sizes.items()]
+        for name in sizes:
+            samples.append(('httpd_cache_lookups_total', 'counter', (('cache', name), ('result', 'hit')), hits[name]))
+            samples.append(('httpd_cache_lookups_total', 'counter', (('cache', name), ('result', 'miss')), misses[name]))
+        stale = sum(site.cache.stale for site in self._all_sites())
+        samples.append(('httpd_cache_lookups_total', 'counter', (('cache', 'file'), ('result', 'stale')), stale))
+        if self.access_log is not None:
+            samples.append(('httpd_access_log_dropped_total', 'counter', (), self.access_log.dropped))
+        text = self.metrics.render(samples).encode()
+        return [gen_headers(OK, len(text), 'text/plain; version=0.0.4', keep_alive) + text], keep_alive
+
+    def _caches(self):
+        return [cache for site in self._all_sites() for cache in site.caches()]
+
+    def _handle(self, headers, can_keep_alive, shard, trace=None):
+        keep_alive = can_keep_alive and self._keep_alive(headers)
+        if self.metrics_path and headers['path'] == self.metrics_path:
+            return self._metrics_response(keep_alive)
+        if self.health_path and headers['path'] == self.health_path:
+            return self._health_response(keep_alive)
+        site = self._site_for(headers.get('host', ''))
+        if headers['command'] in ('PUT', 'POST'):
+            return self._start_upload(site, headers, keep_alive)
+        started = time.perf_counter()
+        resolved, query = self._resolve_path(site, headers['path'])
+        shard.observe(PHASE_RESOLVE, time.perf_counter() - started)
+        if trace is not None:
+            trace.mark('resolve')
+        if resolved.status == FORBIDDEN:
+            return self._error_response(FORBIDDEN, 'Access denied', keep_alive)
+        if resolved.listing:
+            return self._listing_response(site, headers, resolved.path, query, keep_alive)
+        head = headers['command'] == 'HEAD'
+        entry = None
+        if resolved.status == OK:
+            started = time.perf_counter()
+            entry = self._get_file(site, resolved.path, with_body=not head)
+            shard.observe(PHASE_READ, time.perf_counter() - started)
+            if trace is not None:
+                trace.mark('read')
+            if entry is None:
+                # the file went away since it was resolved
+                site.paths.invalidate(headers['path'].partition('?')[0])
 
-        html = get_html_from_path(path)
-        if html:
-            return gen_headers(OK, len(html), content_type).encode() + html
+        if entry is not None:
+            entry, encoding, vary = self._negotiate_encoding(site, headers, entry, head)
+            validators = {'ETag': entry.etag, 'Last-Modified': entry.last_modified}
+            if encoding:
+                validators['Content-Encoding'] = encoding
+            if vary:
+                validators['Vary'] = 'Accept-Encoding'
+            cache_control = self._cache_control_for(site, entry.content_type)
+            if cache_control:
+                validators['Cache-Control'] = cache_control
+            if self._not_modified(headers, entry):
+                return [gen_headers(NOT_MODIFIED, None, None, keep_alive, validators)], keep_alive
+            validators['Accept-Ranges'] = 'bytes'
+            range_header = headers.get('range', '')
+            if range_header and self._if_range_matches(headers, entry):
+                ranges = parse_range(range_header, entry.size)
+                if ranges == []:
+                    validators['Content-Range'] = f'bytes */{entry.size}'
+                    return [gen_headers(RANGE_NOT_SATISFIABLE, 0, None, keep_alive, validators)], keep_alive
+                if ranges:
+                    return self._ranged_response(entry, ranges, head, keep_alive, validators), keep_alive
+            response_headers = gen_headers(OK, entry.size, entry.content_type, keep_alive, validators)
+            if head:
+                return [response_headers], keep_alive
+            if entry.body is not None:
+                return [response_headers, entry.body], keep_alive
+            if entry.size >= self.sendfile_threshold:
+                return [response_headers, FileRegion(entry.path, 0, entry.size)], keep_alive
+            return [response_headers + get_html_from_path(entry.path)], keep_alive
 
-        html_err = HTML_ERROR.format(status=NOT_FOUND, text='Page not found').encode()
-        return gen_headers(NOT_FOUND, len(html_err), 'text/html').encode() + html_err
+        return self._error_response(NOT_FOUND, 'Page not found', keep_alive)
 
 
 def create_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--ip', default=HOST)
     parser.add_argument('-p', '--port', default=PORT, type=int)
+    parser.add_argument('--https-port', default=None, type=int,
+                        help='also serve HTTPS on this port, needs --cert')
+    parser.add_argument('--cert', default=None, help='PEM certificate chain for HTTPS, may include the key')
+    parser.add_argument('--key', default=None, help='PEM private key for HTTPS if not in --cert')
+    parser.add_argument('--tls-tickets', default=2, type=int,
+                        help='TLS 1.3 session tickets issued per handshake for resumption, 0 disables tickets')
     parser.add_argument('-w', '--workers', default=4, type=int)
     parser.add_argument('-r', '--documentroot', default=DOCUMENT_ROOT)
+    parser.add_argument('--vhosts', default=None, metavar='FILE',
+                        help='JSON file of virtual hosts with their own roots and caches, reloaded when it changes')
+    parser.add_argument('-m', '--mode', default=MODE_THREADS, choices=[MODE_THREADS, MODE_EVENTS],
+                        help='threads: blocking accept per worker, events: selector loop per worker')
+    parser.add_argument('-n', '--processes', default=1, type=int,
+                        help='number of forked worker processes sharing the listening socket')
+    parser.add_argument('-k', '--keepalive-timeout', default=5, type=float,
+                        help='seconds an idle persistent connection is kept open')
+    parser.add_argument('--max-requests', default=100, type=int,
+                        help='requests served over one connection before it is closed')
+    parser.add_argument('--backlog', default=1024, type=int,
+                        help='length of the kernel queue of connections waiting to be accepted')
+    parser.add_argument('--max-connections', default=0, type=int,
+                        help='open connections per process, more are answered with 503 (0: unlimited)')
+    parser.add_argument('--max-connections-per-ip', default=0, type=int,
+                        help='open connections from one client address per process (0: unlimited)')
+    parser.add_argument('--retry-after', default=1, type=int,
+                        help='Retry-After seconds sent with 503 to rejected connections')
+    parser.add_argument('--io-threads', default=0, type=int,
+                        help='events mode: threads answering requests that read the disk, 0 reads in the event loop')
+    parser.add_argument('--io-queue', default=256, type=int,
+                        help='requests waiting for the I/O threads, more are answered in the event loop')
+    parser.add_argument('--drain-timeout', default=10, type=float,
+                        help='seconds in-flight requests may take to finish on shutdown or reload')
+    parser.add_argument('--cache-size', default=64, type=float,
+                        help='static file cache size in megabytes, 0 disables caching')
+    parser.add_argument('--cache-entry-size', default=1024, type=float,
+                        help='largest file kept in the cache, in kilobytes')
+    parser.add_argument('--sendfile-threshold', default=64, type=float,
+                        help='uncached files from this size in kilobytes are sent with sendfile')
+    parser.add_argument('--mmap-cache-size', default=0, type=float,
+                        help='megabytes of files too big for the cache to serve from memory maps, 0 disables')
+    parser.add_argument('--mmap-max-size', default=16, type=float,
+                        help='largest memory-mapped file in megabytes')
+    parser.add_argument('--autoindex', action='store_true',
+                        help='list directories without index.html as HTML, or JSON with ?format=json')
+    parser.add_argument('--autoindex-page-size', default=1000, type=int,
+                        help='directory entries per listing page')
+    parser.add_argument('--autoindex-cache-size', default=8, type=float,
+                        help='cache of scanned directories in megabytes')
+    parser.add_argument('--max-age', action='append', default=[], metavar='MIME=SECONDS',
+                        help='Cache-Control max-age for a MIME type, "image/*" or "*", may be repeated')
+    parser.add_argument('--compress-cache-size', default=16, type=float,
+                        help='cache of gzip/brotli compressed files in megabytes, 0 disables on-the-fly compression')
+    parser.add_argument('--max-header-size', default=8192, type=int,
+                        help='largest request line plus headers in bytes, also the per-connection buffer size')
+    parser.add_argument('--max-headers', default=100, type=int,
+                        help='largest number of request header fields')
+    parser.add_argument('--path-cache-size', default=4, type=float,
+                        help='cache of resolved request paths in megabytes')
+    parser.add_argument('--negative-ttl', default=1.0, type=float,
+                        help='seconds a 404/403 path resolution is cached')
+    parser.add_argument('--preload', action='store_true',
+                        help='warm the caches from the document root in the background at startup')
+    parser.add_argument('--preload-budget', default=64, type=float,
+                        help='megabytes of file contents and compressed variants to preload')
+    parser.add_argument('--preload-include', action='append', default=[], metavar='GLOB',
+                        help='preload only paths relative to the document root matching it, may be repeated')
+    parser.add_argument('--preload-exclude', action='append', default=[], metavar='GLOB',
+                        help='skip paths relative to the document root matching it, may be repeated')
+    parser.add_argument('--preload-compress', action='store_true',
+                        help='also compress preloaded text files for the compressed cache')
+    parser.add_argument('--health-path', default=None,
+                        help='answer 200 on this request path once warmed up, 503 while preloading or draining')
+    parser.add_argument('--upload-path', default=None, metavar='PREFIX',
+                        help='accept PUT and POST uploads of files under this request path prefix, e.g. /artifacts/')
+    parser.add_argument('--max-body-size', default=1024, type=float,
+                        help='largest upload in megabytes')
+    parser.add_argument('--metrics-path', default=None,
+                        help='serve Prometheus metrics on this request path, e.g. /metrics')
+    parser.add_argument('--trace-slow', default=None, type=float, metavar='MS',
+                        help='log the phase breakdown of requests slower than this many milliseconds')
+    parser.add_argument('--trace-dir', default=None,
+                        help='also write slow request breakdowns and profiles as files into this directory')
+    parser.add_argument('--trace-keep', default=100, type=int,
+                        help='newest files kept in the trace directory per process')
+    parser.add_argument('--profile-rate', default=0.0, type=float,
+                        help='fraction of requests to run under cProfile, needs --trace-dir')
+    parser.add_argument('--access-log', default=None, help='access log file, "-" for stdout')
+    parser.add_argument('--access-log-format', default=ACCESS_LOG_COMBINED, choices=[ACCESS_LOG_COMBINED, ACCESS_LOG_JSON])
+    parser.add_argument('--access-log-queue', default=10000, type=int,
+                        help='records buffered for the access log writer before new ones are dropped')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
     return parser
 
 
+def parse_max_ages(values) -> dict:
+    max_ages = {}
+    for value in values:
+        mime, _, seconds = value.partition('=')
+        max_ages[mime.strip()] = int(seconds)
+    return max_ages
+
+
+def load_vhosts(path) -> list:
+    """ Reads the virtual hosts file, a JSON object of host names to their settings:
+        {"example.com": {"root": "/srv/example", "aliases": ["www.example.com"], "index": ["index.html"],
+                         "cache_size": 8, "autoindex": false, "max_age": {"image/*": 86400},
+                         "mime_types": {".wasm": "application/wasm"}}}
+        sizes are in the units of the matching command line options, omitted settings take their values
+        returns list of tuple: host names, Site keyword arguments
+    """
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError('expected an object of host names')
+    hosts = []
+    for name, settings in config.items():
+        if not isinstance(settings, dict) or 'root' not in settings:
+            raise ValueError(f'{name}: settings with a root are required')
+        unknown = set(settings) - VHOST_KEYS
+        if unknown:
+            raise ValueError(f'{name}: unknown settings {", ".join(sorted(unknown))}')
+        if not os.path.isdir(settings['root']):
+            raise ValueError(f'{name}: root {settings["root"]} is not a directory')
+        kwargs = {'document_root': settings['root']}
+        for key, unit in VHOST_SIZES.items():
+            if key in settings:
+                kwargs[key] = int(float(settings[key]) * unit)
+        if 'index' in settings:
+            kwargs['index_files'] = [settings['index']] if isinstance(settings['index'], str) else settings['index']
+        if 'autoindex' in settings:
+            kwargs['autoindex'] = bool(settings['autoindex'])
+        if 'max_age' in settings:
+            kwargs['max_ages'] = {mime: int(seconds) for mime, seconds in settings['max_age'].items()}
+        if 'mime_types' in settings:
+            kwargs['mime_types'] = {('' if ext.startswith('.') else '.') + ext.lower(): mime
+                                    for ext, mime in settings['mime_types'].items()}
+        names = [name] + list(settings.get('aliases', []))
+        hosts.append(([host.lower() for host in names], kwargs))
+    return hosts
+
+
 def get_config() -> dict:
     parser = create_parser()
     namespace = parser.parse_args()
+    if namespace.https_port and not namespace.cert:
+        parser.error('--https-port needs --cert')
+    if namespace.profile_rate and not namespace.trace_dir:
+        parser.error('--profile-rate needs --trace-dir')
     return {
         'host': namespace.ip,
         'port': namespace.port,
+        'tls_port': namespace.https_port,
+        'certfile': namespace.cert,
+        'keyfile': namespace.key,
+        'tls_tickets': namespace.tls_tickets,
         'workers': namespace.workers,
         'document_root': namespace.documentroot,
+        'vhosts': namespace.vhosts,
+        'mode': namespace.mode,
+        'processes': namespace.processes,
+        'keepalive_timeout': namespace.keepalive_timeout,
+        'max_requests': namespace.max_requests,
+        'drain_timeout': namespace.drain_timeout,
+        'backlog': namespace.backlog,
+        'max_connections': namespace.max_connections,
+        'max_connections_per_ip': namespace.max_connections_per_ip,
+        'retry_after': namespace.retry_after,
+        'io_threads': namespace.io_threads,
+        'io_queue': namespace.io_queue,
+        'cache_size': int(namespace.cache_size * 1024 * 1024),
+        'cache_entry_size': int(namespace.cache_entry_size * 1024),
+        'sendfile_threshold': int(namespace.sendfile_threshold * 1024),
+        'mmap_cache_size': int(namespace.mmap_cache_size * 1024 * 1024),
+        'mmap_max_size': int(namespace.mmap_max_size * 1024 * 1024),
+        'autoindex': namespace.autoindex,
+        'autoindex_page_size': namespace.autoindex_page_size,
+        'autoindex_cache_size': int(namespace.autoindex_cache_size * 1024 * 1024),
+        'max_ages': parse_max_ages(namespace.max_age),
+        'compress_cache_size': int(namespace.compress_cache_size * 1024 * 1024),
+        'max_header_size': namespace.max_header_size,
+        'max_headers': namespace.max_headers,
+        'path_cache_size': int(namespace.path_cache_size * 1024 * 1024),
+        'negative_ttl': namespace.negative_ttl,
+        'metrics_path': namespace.metrics_path,
+        'preload': namespace.preload,
+        'preload_budget': int(namespace.preload_budget * 1024 * 1024),
+        'preload_include': namespace.preload_include,
+        'preload_exclude': namespace.preload_exclude,
+        'preload_compress': namespace.preload_compress,
+        'health_path': namespace.health_path,
+        'upload_path': namespace.upload_path,
+        'max_body_size': int(namespace.max_body_size * 1024 * 1024),
+        'trace_slow': namespace.trace_slow / 1000 if namespace.trace_slow is not None else None,
+        'trace_dir': namespace.trace_dir,
+        'trace_keep': namespace.trace_keep,
+        'profile_rate': namespace.profile_rate,
+        'access_log': namespace.access_log,
+        'access_log_format': namespace.access_log_format,
+        'access_log_queue': namespace.access_log_queue,
+        'log_level': namespace.log_level,
     }
 
 
 if __name__ == '__main__':
     config = get_config()
+    logging.getLogger().setLevel(config.pop('log_level'))
     logging.info("Starting web server")
     server = HTTPServer(**config)  # construct server object
     # shut down on ctrl+c
     signal.signal(signal.SIGINT, server.shutdown)
+    signal.signal(signal.SIGTERM, server.shutdown)
+    # reload without downtime on SIGHUP
+    signal.signal(signal.SIGHUP, server.reload)
     server.start()  # aquire the socket
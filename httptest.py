@@ -3,13 +3,24 @@
 import sys
 v3 = sys.version_info[0] == 3
 
+import os
 import re
+import json
+import gzip
 import socket
+import subprocess
+import tempfile
+import shutil
+import time
 if v3:
   import http.client as httplib
 else:
   import httplib
 import unittest
+try:
+  import ssl
+except ImportError:
+  ssl = None
 
 class HttpServer(unittest.TestCase):
   host = "localhost"
@@ -225,6 +236,142 @@ class HttpServer(unittest.TestCase):
     else:
       self.assertIn(int(code), (400,405))
 
+  def raw_status(self, request):
+    """ Sends raw bytes, returns the status code of the response """
+    s = socket.create_connection((self.host, self.port), timeout=10)
+    s.sendall(request)
+    data = b""
+    while b"\r\n" not in data:
+      buf = s.recv(1024)
+      if not buf: break
+      data += buf
+    s.close()
+    return int(data.split(b" ")[1])
+
+  def test_header_block_too_large(self):
+    """oversized header block gets 431"""
+    request = b"GET /httptest/dir2/page.html HTTP/1.1\r\nHost: localhost\r\nCookie: " + b"a" * 20000 + b"\r\n\r\n"
+    self.assertEqual(self.raw_status(request), 431)
+
+  def test_too_many_headers(self):
+    """too many header fields get 431"""
+    request = b"GET /httptest/dir2/page.html HTTP/1.1\r\n" + b"X-A: b\r\n" * 200 + b"\r\n"
+    self.assertEqual(self.raw_status(request), 431)
+
+  def test_malformed_header_line(self):
+    """header line without a colon gets 400"""
+    request = b"GET /httptest/dir2/page.html HTTP/1.1\r\nHost: localhost\r\nbadline\r\n\r\n"
+    self.assertEqual(self.raw_status(request), 400)
+
+  def validators(self, path):
+    self.conn.request("HEAD", path)
+    r = self.conn.getresponse()
+    r.read()
+    return r.getheader("ETag"), r.getheader("Last-Modified")
+
+  def test_if_none_match(self):
+    """If-None-Match with the current ETag gets 304"""
+    etag, last_modified = self.validators("/httptest/dir2/page.html")
+    self.assertIsNotNone(etag)
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"If-None-Match": etag})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 304)
+    self.assertEqual(r.getheader("ETag"), etag)
+    self.assertEqual(len(data), 0)
+
+  def test_if_none_match_changed(self):
+    """If-None-Match with another ETag gets the file"""
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"If-None-Match": '"other"'})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(len(data), 38)
+
+  def test_if_modified_since(self):
+    """If-Modified-Since with Last-Modified gets 304"""
+    etag, last_modified = self.validators("/httptest/dir2/page.html")
+    self.assertIsNotNone(last_modified)
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"If-Modified-Since": last_modified})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 304)
+    self.assertEqual(len(data), 0)
+
+  def test_if_modified_since_older(self):
+    """If-Modified-Since before the file changed gets the file"""
+    self.conn.request("GET", "/httptest/dir2/page.html",
+                      headers={"If-Modified-Since": "Thu, 01 Jan 1970 00:00:01 GMT"})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(len(data), 38)
+
+  def test_range_single(self):
+    """single byte range"""
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"Range": "bytes=6-11"})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 206)
+    self.assertEqual(r.getheader("Content-Range"), "bytes 6-11/38")
+    self.assertEqual(int(r.getheader("Content-Length")), 6)
+    self.assertEqual(data, b"<body>")
+
+  def test_range_suffix(self):
+    """suffix byte range"""
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"Range": "bytes=-8"})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 206)
+    self.assertEqual(r.getheader("Content-Range"), "bytes 30-37/38")
+    self.assertEqual(data, b"</html>\n")
+
+  def test_range_multipart(self):
+    """several ranges in multipart/byteranges"""
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"Range": "bytes=0-5,12-15"})
+    r = self.conn.getresponse()
+    data = r.read()
+    ctype = r.getheader("Content-Type")
+    self.assertEqual(int(r.status), 206)
+    self.assertTrue(ctype.startswith("multipart/byteranges; boundary="), ctype)
+    boundary = ctype.split("boundary=")[1].encode()
+    self.assertEqual(int(r.getheader("Content-Length")), len(data))
+    parts = data.split(b"--" + boundary)
+    self.assertEqual(len(parts), 4)
+    self.assertTrue(parts[3].startswith(b"--"))
+    self.assertIn(b"Content-Range: bytes 0-5/38\r\n\r\n<html>\r\n", parts[1])
+    self.assertIn(b"Content-Range: bytes 12-15/38\r\n\r\nPage\r\n", parts[2])
+
+  def test_if_range_mismatch(self):
+    """If-Range with another ETag gets the whole file"""
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"Range": "bytes=6-11", "If-Range": '"other"'})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 200)
+    self.assertIsNone(r.getheader("Content-Range"))
+    self.assertEqual(len(data), 38)
+
+  def test_if_range_match(self):
+    """If-Range with the current ETag gets the range"""
+    self.conn.request("HEAD", "/httptest/dir2/page.html")
+    r = self.conn.getresponse()
+    r.read()
+    etag = r.getheader("ETag")
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"Range": "bytes=6-11", "If-Range": etag})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 206)
+    self.assertEqual(data, b"<body>")
+
+  def test_range_not_satisfiable(self):
+    """range past the end of file"""
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"Range": "bytes=100-"})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 416)
+    self.assertEqual(r.getheader("Content-Range"), "bytes */38")
+    self.assertEqual(len(data), 0)
+
   def test_filetype_html(self):
     """Content-Type for .html"""
     self.conn.request("GET", "/httptest/dir2/page.html")
@@ -321,10 +468,458 @@ class HttpServer(unittest.TestCase):
     self.assertEqual(len(data), 35344)
     self.assertEqual(ctype, "application/x-shockwave-flash")
 
+@unittest.skipUnless(v3, "the server needs Python 3")
+class ServerProcess(unittest.TestCase):
+  """ Base for test cases that start their own server, server_args() may prepare files in cls.tmp """
+  host = "localhost"
+  port = 8081
+  ports = ()
+
+  @classmethod
+  def server_args(cls):
+    return []
+
+  @classmethod
+  def setUpClass(cls):
+    cls.tmp = tempfile.mkdtemp()
+    try:
+      args = cls.server_args()
+    except BaseException:
+      shutil.rmtree(cls.tmp)
+      raise
+    here = os.path.dirname(os.path.abspath(__file__))
+    devnull = open(os.devnull, "w")
+    cls.server = subprocess.Popen([sys.executable, os.path.join(here, "httpd.py"), "-p", str(cls.port)] + args,
+                                  cwd=here, stdout=devnull, stderr=devnull)
+    deadline = time.time() + 10
+    for port in (cls.port,) + tuple(cls.ports):
+      while True:
+        try:
+          socket.create_connection((cls.host, port), timeout=1).close()
+          break
+        except socket.error:
+          if time.time() > deadline or cls.server.poll() is not None:
+            cls.tearDownClass()
+            raise
+          time.sleep(0.1)
+
+  @classmethod
+  def tearDownClass(cls):
+    if cls.server.poll() is None:
+      cls.server.terminate()
+      cls.server.wait()
+    shutil.rmtree(cls.tmp)
+
+  def request(self, method, path, body=None, headers={}):
+    """ Request over a new connection, returns the response and its body """
+    conn = httplib.HTTPConnection(self.host, self.port, timeout=10)
+    conn.request(method, path, body, headers)
+    r = conn.getresponse()
+    data = r.read()
+    conn.close()
+    return r, data
+
+  def raw(self, request, body=b"", interim=False):
+    """ Sends raw bytes, the body only after an interim response if asked to wait for one,
+        returns everything received until the server closes the connection
+    """
+    s = socket.create_connection((self.host, self.port), timeout=10)
+    s.sendall(request)
+    data = b""
+    while interim and b"\r\n\r\n" not in data:
+      data += s.recv(1024)
+    s.sendall(body)
+    while 1:
+      buf = s.recv(65536)
+      if not buf: break
+      data += buf
+    s.close()
+    return data
+
+
+@unittest.skipUnless(ssl, "HTTPS tests need ssl")
+class HttpsServer(ServerProcess):
+  """ HTTP and HTTPS ports served by one server, the certificate is made for the run """
+  port = 8081
+  https_port = 8443
+  ports = (https_port,)
+
+  @classmethod
+  def server_args(cls):
+    cls.cert = os.path.join(cls.tmp, "cert.pem")
+    key = os.path.join(cls.tmp, "key.pem")
+    devnull = open(os.devnull, "w")
+    try:
+      subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                             "-subj", "/CN=localhost", "-keyout", key, "-out", cls.cert],
+                            stdout=devnull, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+      raise unittest.SkipTest("openssl is needed to make a certificate")
+    return ["--https-port", str(cls.https_port), "--cert", cls.cert, "--key", key]
+
+  def setUp(self):
+    self.context = ssl.create_default_context(cafile=self.cert)
+    self.context.check_hostname = False
+
+  def get(self, path, session=None):
+    """ GET over a new TLS connection, returns the response, its body, the TLS session and whether it was resumed """
+    s = self.context.wrap_socket(socket.create_connection((self.host, self.https_port), timeout=10),
+                                 server_hostname=self.host, session=session)
+    conn = httplib.HTTPSConnection(self.host, self.https_port, timeout=10, context=self.context)
+    conn.sock = s
+    conn.request("GET", path)
+    r = conn.getresponse()
+    data = r.read()
+    session, reused = s.session, s.session_reused
+    conn.close()
+    return r, data, session, reused
+
+  def test_https_get(self):
+    """GET over TLS"""
+    r, data, session, reused = self.get("/httptest/dir2/page.html")
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(int(r.getheader("Content-Length")), 38)
+    self.assertEqual(len(data), 38)
+    self.assertEqual(r.getheader("Content-Type"), "text/html")
+
+  def test_https_large_file(self):
+    """large file over TLS"""
+    r, data, session, reused = self.get("/httptest/wikipedia_russia.html")
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(len(data), int(r.getheader("Content-Length")))
+
+  def test_session_resumption(self):
+    """TLS session resumed on reconnect"""
+    r, data, session, reused = self.get("/httptest/dir2/page.html")
+    self.assertFalse(reused)
+    r, data, session, reused = self.get("/httptest/dir2/page.html", session=session)
+    self.assertEqual(int(r.status), 200)
+    self.assertTrue(reused)
+
+  def test_http_and_https(self):
+    """HTTP and HTTPS served by one process"""
+    conn = httplib.HTTPConnection(self.host, self.port, timeout=10)
+    conn.request("GET", "/httptest/dir2/page.html")
+    r = conn.getresponse()
+    data = r.read()
+    conn.close()
+    r_tls, data_tls, session, reused = self.get("/httptest/dir2/page.html")
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(int(r_tls.status), 200)
+    self.assertEqual(data, data_tls)
+    self.assertIsNone(self.server.poll())
+
+class UploadServer(ServerProcess):
+  """ PUT and POST uploads under --upload-path into a document root made for the run """
+  port = 8082
+
+  @classmethod
+  def server_args(cls):
+    cls.root = os.path.join(cls.tmp, "www")
+    os.makedirs(os.path.join(cls.root, "upload"))
+    with open(os.path.join(cls.root, "index.html"), "wb") as f:
+      f.write(b"<html>index</html>\n")
+    return ["-r", cls.root, "--upload-path", "/upload", "--max-body-size", "1"]
+
+  def stored(self, path):
+    with open(os.path.join(self.root, path), "rb") as f:
+      return f.read()
+
+  def test_put_content_length(self):
+    """upload with Content-Length"""
+    r, data = self.request("PUT", "/upload/a/b/length.txt", b"hello")
+    self.assertEqual(int(r.status), 201)
+    self.assertEqual(r.getheader("Location"), "/upload/a/b/length.txt")
+    self.assertEqual(self.stored("upload/a/b/length.txt"), b"hello")
+    r, data = self.request("GET", "/upload/a/b/length.txt")
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(data, b"hello")
+
+  def test_put_replaces(self):
+    """upload over an existing file gets 204"""
+    r, data = self.request("PUT", "/upload/replaced.txt", b"first")
+    self.assertEqual(int(r.status), 201)
+    r, data = self.request("POST", "/upload/replaced.txt", b"second")
+    self.assertEqual(int(r.status), 204)
+    self.assertEqual(self.stored("upload/replaced.txt"), b"second")
+    r, data = self.request("GET", "/upload/replaced.txt")
+    self.assertEqual(data, b"second")
+
+  def test_put_chunked(self):
+    """chunked upload"""
+    data = self.raw(b"PUT /upload/chunked.txt HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n"
+                    b"Connection: close\r\n\r\n", b"5\r\nhello\r\n3;ext=1\r\nabc\r\n0\r\n\r\n")
+    self.assertTrue(data.startswith(b"HTTP/1.1 201 "), data[:40])
+    self.assertEqual(self.stored("upload/chunked.txt"), b"helloabc")
+
+  def test_expect_continue(self):
+    """Expect: 100-continue gets an interim response before the body"""
+    data = self.raw(b"PUT /upload/continue.txt HTTP/1.1\r\nHost: localhost\r\nContent-Length: 3\r\n"
+                    b"Expect: 100-continue\r\nConnection: close\r\n\r\n", b"xyz", interim=True)
+    self.assertTrue(data.startswith(b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 201 "), data[:60])
+    self.assertEqual(self.stored("upload/continue.txt"), b"xyz")
+
+  def test_too_large(self):
+    """upload over --max-body-size gets 413"""
+    data = self.raw(b"PUT /upload/large.bin HTTP/1.1\r\nHost: localhost\r\nContent-Length: 1048577\r\n"
+                    b"Connection: close\r\n\r\n")
+    self.assertTrue(data.startswith(b"HTTP/1.1 413 "), data[:40])
+    self.assertFalse(os.path.exists(os.path.join(self.root, "upload", "large.bin")))
+
+  def test_outside_prefix(self):
+    """upload outside the upload path gets 405"""
+    for path in ("/other.txt", "/uploads-other/x.txt", "/upload"):
+      r, data = self.request("PUT", path, b"x")
+      self.assertEqual(int(r.status), 405, path)
+    self.assertFalse(os.path.exists(os.path.join(self.root, "uploads-other")))
+
+  def test_traversal(self):
+    """upload escaping the upload path gets 403"""
+    for path in ("/upload/../index.html", "/upload/%2e%2e/index.html", "/upload/a/%2E%2E%2F..%2Findex.html",
+                 "/upload/./../index.html"):
+      r, data = self.request("PUT", path, b"owned")
+      self.assertEqual(int(r.status), 403, path)
+    self.assertEqual(self.stored("index.html"), b"<html>index</html>\n")
+
+class AutoindexServer(ServerProcess):
+  """ Directory listings with --autoindex over a document root made for the run """
+  port = 8083
+
+  @classmethod
+  def server_args(cls):
+    cls.root = os.path.join(cls.tmp, "www")
+    for path, size, mtime in (("list/b.txt", 10, 3000), ("list/a.txt", 3, 1000), ("list/c.txt", 1, 2000),
+                              ("list/.hidden", 1, 1000), ("with_index/index.html", 5, 1000),
+                              ("grow/old.txt", 1, 1000)):
+      path = os.path.join(cls.root, path)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(path, "wb") as f:
+        f.write(b"x" * size)
+      os.utime(path, (mtime, mtime))
+    os.makedirs(os.path.join(cls.root, "list", "sub"))
+    return ["-r", cls.root, "--autoindex", "--autoindex-page-size", "2"]
+
+  def listing(self, path):
+    r, data = self.request("GET", path)
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(r.getheader("Content-Type"), "application/json")
+    return json.loads(data.decode())
+
+  def names(self, query):
+    return [entry["name"] for entry in self.listing("/list/?format=json&" + query)["entries"]]
+
+  def test_html_listing(self):
+    """HTML listing of a directory without an index file"""
+    r, data = self.request("GET", "/list/")
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(r.getheader("Content-Type"), "text/html; charset=utf-8")
+    self.assertEqual(int(r.getheader("Content-Length")), len(data))
+    self.assertIn(b"Index of /list/", data)
+    self.assertIn(b'<a href="/list/sub/">sub/</a>', data)
+    self.assertIn(b'<a href="/list/a.txt">a.txt</a>', data)
+    self.assertNotIn(b"b.txt", data)
+    self.assertIn(b"page 1 of 2", data)
+    self.assertNotIn(b".hidden", data)
+
+  def test_json_listing(self):
+    """JSON listing, directories first"""
+    listing = self.listing("/list/?format=json")
+    self.assertEqual(listing["path"], "/list/")
+    self.assertEqual((listing["page"], listing["pages"], listing["total"]), (1, 2, 4))
+    self.assertEqual(listing["entries"], [
+      {"name": "sub", "type": "directory", "size": 0, "mtime": listing["entries"][0]["mtime"]},
+      {"name": "a.txt", "type": "file", "size": 3, "mtime": 1000},
+    ])
+
+  def test_sort_order_page(self):
+    """listing sorted by size and mtime, descending and paged"""
+    self.assertEqual(self.names("sort=size&page=2"), ["a.txt", "b.txt"])
+    self.assertEqual(self.names("sort=size&order=desc"), ["b.txt", "a.txt"])
+    self.assertEqual(self.names("sort=mtime&page=1"), ["a.txt", "c.txt"])
+    self.assertEqual(self.names("sort=name&order=desc&page=2"), ["b.txt", "a.txt"])
+    self.assertEqual(self.listing("/list/?format=json&page=9")["page"], 2)
+    self.assertEqual(self.listing("/list/?format=json&sort=bogus&page=x")["entries"][0]["name"], "sub")
+
+  def test_index_file_preferred(self):
+    """index file served instead of the listing"""
+    r, data = self.request("GET", "/with_index/")
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(data, b"xxxxx")
+
+  def test_rescan(self):
+    """listing rescanned after a file is added"""
+    self.assertEqual(self.listing("/grow/?format=json")["total"], 1)
+    with open(os.path.join(self.root, "grow", "new.txt"), "wb") as f:
+      f.write(b"new")
+    deadline = time.time() + 5
+    while True:
+      listing = self.listing("/grow/?format=json")
+      if listing["total"] == 2 or time.time() > deadline: break
+      time.sleep(0.2)
+    self.assertEqual([entry["name"] for entry in listing["entries"]], ["new.txt", "old.txt"])
+
+class VhostsServer(ServerProcess):
+  """ Virtual hosts from a --vhosts file, the document roots are made for the run """
+  port = 8084
+
+  @classmethod
+  def server_args(cls):
+    cls.vhosts = os.path.join(cls.tmp, "vhosts.json")
+    cls.hosts = {
+      "one.test": {"root": cls.site("one"), "aliases": ["www.one.test"], "max_age": {"text/*": 60}},
+      "two.test": {"root": cls.site("two"), "index": ["home.txt"], "mime_types": {".txt": "text/x-two"}},
+    }
+    cls.write_vhosts(cls.hosts)
+    return ["-r", cls.site("default"), "--vhosts", cls.vhosts]
+
+  @classmethod
+  def site(cls, name):
+    root = os.path.join(cls.tmp, name)
+    if not os.path.isdir(root):
+      os.makedirs(root)
+      with open(os.path.join(root, "home.txt"), "w") as f:
+        f.write(name)
+    return root
+
+  @classmethod
+  def write_vhosts(cls, hosts):
+    with open(cls.vhosts, "w") as f:
+      json.dump(hosts, f)
+
+  def get(self, host, path="/home.txt"):
+    r, data = self.request("GET", path, headers={"Host": host})
+    return int(r.status), data, r
+
+  def test_host(self):
+    """site chosen by the Host header"""
+    self.assertEqual(self.get("one.test")[:2], (200, b"one"))
+    self.assertEqual(self.get("two.test")[:2], (200, b"two"))
+    self.assertEqual(self.get("TWO.test")[:2], (200, b"two"))
+
+  def test_alias(self):
+    """alias served by its site"""
+    self.assertEqual(self.get("www.one.test")[:2], (200, b"one"))
+
+  def test_port_stripped(self):
+    """port in the Host header ignored"""
+    self.assertEqual(self.get("one.test:%d" % self.port)[:2], (200, b"one"))
+    self.assertEqual(self.get("two.test:80")[:2], (200, b"two"))
+
+  def test_unknown_host(self):
+    """unknown or missing host served from the document root"""
+    self.assertEqual(self.get("other.test")[:2], (200, b"default"))
+    self.assertEqual(self.get("localhost:%d" % self.port)[:2], (200, b"default"))
+    data = self.raw(b"GET /home.txt HTTP/1.0\r\n\r\n")
+    self.assertTrue(data.endswith(b"\r\n\r\ndefault"), data[-40:])
+
+  def test_site_settings(self):
+    """index, MIME types and max-age of each site"""
+    status, data, r = self.get("two.test", "/")
+    self.assertEqual((status, data), (200, b"two"))
+    self.assertEqual(r.getheader("Content-Type"), "text/x-two")
+    status, data, r = self.get("one.test")
+    self.assertEqual(r.getheader("Content-Type"), "text/plain")
+    self.assertEqual(r.getheader("Cache-Control"), "max-age=60")
+    self.assertIsNone(self.get("two.test")[2].getheader("Cache-Control"))
+
+  def test_reload(self):
+    """changed vhosts file applied without a restart"""
+    self.assertEqual(self.get("three.test")[:2], (200, b"default"))
+    hosts = dict(self.hosts, **{"three.test": {"root": self.site("three")}})
+    self.write_vhosts(hosts)
+    later = time.time() + 1
+    os.utime(self.vhosts, (later, later))
+    deadline = time.time() + 10
+    while self.get("three.test")[1] != b"three" and time.time() < deadline:
+      time.sleep(0.2)
+    self.assertEqual(self.get("three.test")[:2], (200, b"three"))
+    self.assertEqual(self.get("www.one.test")[:2], (200, b"one"))
+    self.assertIsNone(self.server.poll())
+
+class EncodingServer(ServerProcess):
+  """ Content-Encoding negotiated from Accept-Encoding over a document root made for the run """
+  port = 8085
+  text = b"".join(b"function f%d() { return %d; }\n" % (i, i) for i in range(100))
+
+  @classmethod
+  def server_args(cls):
+    root = os.path.join(cls.tmp, "www")
+    os.makedirs(root)
+    cls.precompressed = gzip.compress(b"precompressed " + cls.text)
+    for name, body, mtime in (("app.js", cls.text, 1000), ("small.js", b"var x = 1;\n", 1000),
+                              ("image.png", cls.text, 1000), ("style.css", cls.text, 1000),
+                              ("style.css.gz", cls.precompressed, 2000), ("stale.css", cls.text, 2000),
+                              ("stale.css.gz", cls.precompressed, 1000)):
+      with open(os.path.join(root, name), "wb") as f:
+        f.write(body)
+      os.utime(os.path.join(root, name), (mtime, mtime))
+    return ["-r", root]
+
+  def get(self, path, accept=None):
+    r, data = self.request("GET", path, headers={"Accept-Encoding": accept} if accept is not None else {})
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(int(r.getheader("Content-Length")), len(data))
+    return r, data
+
+  def test_gzip(self):
+    """gzip body decompresses to the file"""
+    r, data = self.get("/app.js", "gzip")
+    self.assertEqual(r.getheader("Content-Encoding"), "gzip")
+    self.assertEqual(r.getheader("Vary"), "Accept-Encoding")
+    self.assertLess(len(data), len(self.text))
+    self.assertEqual(gzip.decompress(data), self.text)
+    identity, data = self.get("/app.js")
+    self.assertNotEqual(r.getheader("ETag"), identity.getheader("ETag"))
+
+  def test_identity(self):
+    """identity without Accept-Encoding or with gzip;q=0"""
+    for accept in (None, "gzip;q=0", "*;q=0", "deflate"):
+      r, data = self.get("/app.js", accept)
+      self.assertIsNone(r.getheader("Content-Encoding"), accept)
+      self.assertEqual(r.getheader("Vary"), "Accept-Encoding", accept)
+      self.assertEqual(data, self.text, accept)
+
+  def test_wildcard(self):
+    """gzip chosen for * and by q values"""
+    for accept in ("*, br;q=0", "identity;q=0.5, gzip;q=0.8, br;q=0"):
+      r, data = self.get("/app.js", accept)
+      self.assertEqual(r.getheader("Content-Encoding"), "gzip", accept)
+      self.assertEqual(gzip.decompress(data), self.text, accept)
+
+  def test_not_compressed(self):
+    """small files and images sent as is"""
+    r, data = self.get("/small.js", "gzip")
+    self.assertIsNone(r.getheader("Content-Encoding"))
+    self.assertEqual(data, b"var x = 1;\n")
+    r, data = self.get("/image.png", "gzip")
+    self.assertIsNone(r.getheader("Content-Encoding"))
+    self.assertIsNone(r.getheader("Vary"))
+    self.assertEqual(data, self.text)
+
+  def test_precompressed(self):
+    """.gz file next to the requested one served"""
+    r, data = self.get("/style.css", "gzip")
+    self.assertEqual(r.getheader("Content-Encoding"), "gzip")
+    self.assertEqual(r.getheader("Content-Type"), "text/css")
+    self.assertEqual(r.getheader("Vary"), "Accept-Encoding")
+    self.assertEqual(data, self.precompressed)
+
+  def test_stale_precompressed(self):
+    """.gz file older than the requested one ignored"""
+    r, data = self.get("/stale.css", "gzip")
+    self.assertEqual(r.getheader("Content-Encoding"), "gzip")
+    self.assertEqual(gzip.decompress(data), self.text)
+
 loader = unittest.TestLoader()
 suite = unittest.TestSuite()
 a = loader.loadTestsFromTestCase(HttpServer)
 suite.addTest(a)
+suite.addTest(loader.loadTestsFromTestCase(HttpsServer))
+suite.addTest(loader.loadTestsFromTestCase(UploadServer))
+suite.addTest(loader.loadTestsFromTestCase(AutoindexServer))
+suite.addTest(loader.loadTestsFromTestCase(VhostsServer))
+suite.addTest(loader.loadTestsFromTestCase(EncodingServer))
 
 class NewResult(unittest.TextTestResult):
   def getDescription(self, test):
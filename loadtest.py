@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+""" Load generator and benchmark for httpd.py, no external tools required.
+    Starts the server on a free local port (unless --port is given), drives it with
+    --concurrency connections spread over client processes and prints JSON with
+    throughput, latency percentiles and error counts.
+
+    python loadtest.py -c 50 -d 10 --server-args "-m events -w 2"
+    python loadtest.py -o run.json --compare baseline.json --tolerance 0.1
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+logging.basicConfig(format='[%(asctime)s] %(levelname).1s %(message)s',
+                    datefmt='%Y.%m.%d %H:%M:%S',
+                    level=logging.INFO)
+
+HOST = '127.0.0.1'
+DEFAULT_MIX = [
+    'GET /=30',
+    'GET /httptest/dir2/page.html=20',
+    'GET /httptest/jquery-1.9.1.js=15',
+    'GET /httptest/160313.jpg=10',
+    'GET /httptest/no-such-file.html=15',
+    'HEAD /httptest/splash.css=10',
+]
+PERCENTILES = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99, 'p999': 0.999}
+
+
+def parse_mix(values) -> list:
+    """ 'METHOD PATH=WEIGHT' strings to a list of (method, path, weight) """
+    mix = []
+    for value in values:
+        request, _, weight = value.rpartition('=')
+        method, _, path = request.partition(' ')
+        mix.append((method.upper(), path, float(weight)))
+    return mix
+
+
+class ClosedBeforeResponse(ConnectionError):
+    """ The server closed the connection before any byte of the response, as it does with idle keep-alive ones """
+
+
+def read_response(sock, buffer: bytearray, head: bool) -> tuple:
+    """ Reads one response, leaving extra bytes in buffer
+        returns tuple: status, body length, whether the server keeps the connection open
+    """
+    while b'\r\n\r\n' not in buffer:
+        try:
+            chunk = sock.recv(65536)
+        except ConnectionResetError:
+            if buffer:
+                raise
+            chunk = b''
+        if not chunk:
+            if not buffer:
+                raise ClosedBeforeResponse('connection closed before the response')
+            raise ConnectionError('connection closed before headers')
+        buffer += chunk
+    end = buffer.index(b'\r\n\r\n') + 4
+    lines = bytes(buffer[:end - 4]).decode('iso-8859-1').split('\r\n')
+    del buffer[:end]
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        key, _, value = line.partition(':')
+        headers[key.strip().lower()] = value.strip()
+    length = 0 if head or status == 304 else int(headers.get('content-length', 0))
+    while len(buffer) < length:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError('connection closed inside body')
+        buffer += chunk
+    del buffer[:length]
+    return status, length, headers.get('connection', '').lower() != 'close'
+
+
+def send_request(sock, port, request, buffer, head) -> tuple:
+    """ Sends a request and reads its response, on a new connection if sock is None.
+        A reused connection the server closed before answering is replaced and the request sent once more,
+        as HTTP clients do with persistent connections.
+        returns tuple: socket, status, body length, whether the server keeps the connection open, reconnected
+    """
+    reconnected = False
+    while True:
+        reused = sock is not None
+        try:
+            if sock is None:
+                sock = socket.create_connection((HOST, port), timeout=30)
+                buffer.clear()
+            sock.sendall(request)
+            return (sock,) + read_response(sock, buffer, head) + (reconnected,)
+        except (ClosedBeforeResponse, BrokenPipeError, ConnectionResetError):
+            sock.close()
+            sock = None
+            if not reused or reconnected or buffer:
+                raise
+            reconnected = True
+        except (OSError, ValueError, IndexError):
+            if sock is not None:
+                sock.close()
+            raise
+
+
+def run_connection(port, mix, keep_alive, deadline, result, lock):
+    """ Sends requests one after another until the deadline, reconnecting when needed """
+    weights = [weight for _, _, weight in mix]
+    latencies, statuses, errors, reconnects, received = [], {}, 0, 0, 0
+    sock, buffer = None, bytearray()
+    while time.monotonic() < deadline:
+        method, path, _ = random.choices(mix, weights)[0]
+        connection = 'keep-alive' if keep_alive else 'close'
+        request = f'{method} {path} HTTP/1.1\r\nHost: {HOST}\r\nConnection: {connection}\r\n\r\n'.encode()
+        started = time.perf_counter()
+        try:
+            sock, status, length, open_, reconnected = send_request(sock, port, request, buffer, method == 'HEAD')
+        except (OSError, ValueError, IndexError):
+            errors += 1
+            sock = None
+            continue
+        reconnects += reconnected
+        latencies.append(time.perf_counter() - started)
+        statuses[status] = statuses.get(status, 0) + 1
+        received += length
+        if not (keep_alive and open_):
+            sock.close()
+            sock = None
+    if sock is not None:
+        sock.close()
+    with lock:
+        result['latencies'].extend(latencies)
+        result['errors'] += errors
+        result['reconnects'] += reconnects
+        result['bytes'] += received
+        for status, count in statuses.items():
+            result['statuses'][status] = result['statuses'].get(status, 0) + count
+
+
+def run_client_process(port, mix, keep_alive, connections, deadline, queue):
+    result = {'latencies': [], 'errors': 0, 'reconnects': 0, 'bytes': 0, 'statuses': {}}
+    lock = threading.Lock()
+    threads = [threading.Thread(target=run_connection, args=(port, mix, keep_alive, deadline, result, lock))
+               for _ in range(connections)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    queue.put(result)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run_load(port, mix, concurrency, processes, duration, keep_alive) -> dict:
+    processes = max(1, min(processes, concurrency))
+    queue = multiprocessing.Queue()
+    started = time.monotonic()
+    deadline = started + duration
+    workers = []
+    for i in range(processes):
+        connections = concurrency // processes + (1 if i < concurrency % processes else 0)
+        p = multiprocessing.Process(target=run_client_process,
+                                    args=(port, mix, keep_alive, connections, deadline, queue))
+        p.start()
+        workers.append(p)
+    results = [queue.get() for _ in workers]
+    for p in workers:
+        p.join()
+    elapsed = time.monotonic() - started
+
+    latencies = sorted(latency for r in results for latency in r['latencies'])
+    statuses = {}
+    for r in results:
+        for status, count in r['statuses'].items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    report = {
+        'concurrency': concurrency,
+        'keep_alive': keep_alive,
+        'duration': round(elapsed, 3),
+        'requests': len(latencies),
+        'errors': sum(r['errors'] for r in results),
+        'reconnects': sum(r['reconnects'] for r in results),
+        'statuses': statuses,
+        'bytes': sum(r['bytes'] for r in results),
+        'requests_per_second': round(len(latencies) / elapsed, 2),
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+            'max': round(latencies[-1] * 1000, 3) if latencies else None,
+        },
+    }
+    for name, fraction in PERCENTILES.items():
+        value = percentile(latencies, fraction)
+        report['latency_ms'][name] = round(value * 1000, 3) if value is not None else None
+    return report
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, server_args):
+    """ Launches httpd.py from this directory and waits until it accepts connections """
+    here = os.path.dirname(os.path.abspath(__file__))
+    command = [sys.executable, os.path.join(here, 'httpd.py'), '-i', HOST, '-p', str(port),
+               '-r', os.path.join(here, 'www')] + shlex.split(server_args)
+    logging.info(f'Starting server: {" ".join(command)}')
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f'server did not start on port {port}')
+
+
+def compare(report, baseline, tolerance) -> list:
+    """ Regressions of report against baseline beyond the relative tolerance """
+    regressions = []
+    if report['requests_per_second'] < baseline['requests_per_second'] * (1 - tolerance):
+        regressions.append(f"requests_per_second {report['requests_per_second']} "
+                           f"< baseline {baseline['requests_per_second']}")
+    for name in PERCENTILES:
+        current, before = report['latency_ms'].get(name), baseline['latency_ms'].get(name)
+        if current is not None and before is not None and current > before * (1 + tolerance):
+            regressions.append(f'latency {name} {current} ms > baseline {before} ms')
+    if report['errors'] > baseline['errors']:
+        regressions.append(f"errors {report['errors']} > baseline {baseline['errors']}")
+    return regressions
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Load test httpd.py')
+    parser.add_argument('-c', '--concurrency', default=10, type=int, help='simultaneous connections')
+    parser.add_argument('-d', '--duration', default=10, type=float, help='seconds to generate load')
+    parser.add_argument('-P', '--client-processes', default=os.cpu_count() or 1, type=int,
+                        help='processes the client connections are spread over')
+    parser.add_argument('--no-keepalive', action='store_true', help='one request per connection')
+    parser.add_argument('--mix', action='append', metavar='"METHOD PATH=WEIGHT"',
+                        help=f'request mix entry, may be repeated (default: {DEFAULT_MIX})')
+    parser.add_argument('-p', '--port', type=int, help='use a server already listening on this port')
+    parser.add_argument('--server-args', default='', help='extra httpd.py arguments for the started server')
+    parser.add_argument('-o', '--output', help='write the JSON report to this file')
+    parser.add_argument('--compare', help='baseline JSON report, exit with 1 on regressions')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='allowed relative regression')
+    return parser
+
+
+def main():
+    namespace = create_parser().parse_args()
+    mix = parse_mix(namespace.mix or DEFAULT_MIX)
+    port = namespace.port
+    server = None
+    if port is None:
+        port = free_port()
+        server = start_server(port, namespace.server_args)
+    try:
+        report = run_load(port, mix, namespace.concurrency, namespace.client_processes,
+                          namespace.duration, not namespace.no_keepalive)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(10)
+    report['server_args'] = namespace.server_args
+    output = json.dumps(report, indent=2)
+    print(output)
+    if namespace.output:
+        with open(namespace.output, 'w') as f:
+            f.write(output + '\n')
+    if namespace.compare:
+        with open(namespace.compare) as f:
+            regressions = compare(report, json.load(f), namespace.tolerance)
+        for regression in regressions:
+            logging.info(f'REGRESSION: {regression}')
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
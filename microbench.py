@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+""" Micro-benchmarks of the per-request CPU cost of httpd.py:
+    header parsing, response header serialization and a whole cached-file request.
+    Usage: python microbench.py [-n NUMBER]
+"""
+import argparse
+import logging
+import timeit
+
+import httpd
+
+REQUEST = (b"GET /httptest/dir2/page.html?arg1=value HTTP/1.1\r\n"
+           b"Host: localhost:8080\r\n"
+           b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0\r\n"
+           b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,*/*;q=0.8\r\n"
+           b"Accept-Language: en-US,en;q=0.5\r\n"
+           b"Accept-Encoding: gzip, deflate, br\r\n"
+           b"Connection: keep-alive\r\n"
+           b"Cookie: session=0123456789abcdef0123456789abcdef; theme=dark\r\n"
+           b"Upgrade-Insecure-Requests: 1\r\n"
+           b"\r\n")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', default=100000, type=int)
+    number = parser.parse_args().number
+    logging.disable(logging.CRITICAL)
+    server = httpd.HTTPServer(httpd.HOST, httpd.PORT, 1, httpd.DOCUMENT_ROOT)
+    server.handle_request(REQUEST, True)  # warm the file cache
+    cases = {
+        'parse headers': lambda: server._get_headers(REQUEST),
+        'gen headers': lambda: httpd.gen_headers(httpd.OK, 38, 'text/html', True,
+                                                 {'ETag': '"1-26"', 'Accept-Ranges': 'bytes'}),
+        'cached request': lambda: server.handle_request(REQUEST, True),
+    }
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=number, repeat=3))
+        print(f'{name:<16} {seconds / number * 1e6:8.2f} us/call')
+
+
+if __name__ == '__main__':
+    main()